@@ -0,0 +1,316 @@
+import os
+import json
+import fcntl
+import bisect
+import logging
+import argparse
+import datetime
+from collections import defaultdict
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects import postgresql, sqlite
+from app import app, db, basedir
+from models import Conversation, ConversationRollup, RollupUser, LATENCY_BUCKETS_MS
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ("hour", "day", "all")
+ALL_TIME = datetime.datetime(1970, 1, 1)
+TOTAL = "*"
+
+ROLLUP_KEY = ("granularity", "bucket_start", "category", "intent")
+ROLLUP_COUNTERS = ("conversations", "followups", "prompt_tokens", "completion_tokens", "total_tokens",
+                   "cached_tokens", "latency_ms_total", "active_users")
+# 啟動時自動重建 rollup 所用的檔案鎖（見 ensure_rollups）
+ROLLUP_REBUILD_LOCK = os.path.join(basedir, ".rollup-rebuild.lock")
+# OpenAI 對命中 prompt 快取的 token 收取的價格比例（gpt-4o 為一般 prompt token 的一半）
+CACHED_TOKEN_PRICE_RATIO = float(os.environ.get("CACHED_TOKEN_PRICE_RATIO", "0.5"))
+
+
+def bucket_start(granularity, timestamp):
+    """回傳時間戳所屬統計區間的起點"""
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    elif granularity == "day":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ALL_TIME
+
+def latency_bucket(latency_ms):
+    """延遲所屬的直方圖格子索引"""
+    return bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms or 0)
+
+def _keys(conversation):
+    category = conversation.category or "N/A"
+    intent = conversation.intent or "N/A"
+    return [(category, intent), (TOTAL, TOTAL)]
+
+
+class _Totals:
+    """單一 rollup 列的累加值（重建時於記憶體中使用）"""
+
+    def __init__(self):
+        self.conversations = 0
+        self.followups = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.cached_tokens = 0
+        self.latency_ms_total = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.users = set()
+
+
+def _add(target, conversation, histogram):
+    target.conversations += 1
+    target.followups += 1 if conversation.needs_followup else 0
+    target.prompt_tokens += conversation.prompt_tokens or 0
+    target.completion_tokens += conversation.completion_tokens or 0
+    target.total_tokens += conversation.total_tokens or 0
+    target.cached_tokens += conversation.cached_tokens or 0
+    target.latency_ms_total += conversation.latency_ms or 0
+    histogram[latency_bucket(conversation.latency_ms)] += 1
+
+def _accumulate(totals, conversation, granularities):
+    # 與後續訊息合併回覆的訊息沒有獨立的 LLM 呼叫，不列入統計
+    if conversation.merged:
+        return
+    for granularity in granularities:
+        bucket = bucket_start(granularity, conversation.timestamp or datetime.datetime.utcnow())
+        for category, intent in _keys(conversation):
+            target = totals[(granularity, bucket, category, intent)]
+            _add(target, conversation, target.histogram)
+            if category == TOTAL:
+                target.users.add(conversation.user_id)
+
+def _insert(table):
+    # INSERT ... ON CONFLICT 的寫法依資料庫而異，支援 SQLite 與 PostgreSQL
+    inserts = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+    return inserts[db.session.get_bind().dialect.name](table)
+
+def _apply_totals(totals):
+    """
+    將記憶體中的累加值併入 rollup 列。計數欄位以 INSERT ... ON CONFLICT DO UPDATE 原子地累加，
+    多個 worker 同時寫入同一列也不會遺失；該列在交易結束前保持鎖定，接著合併延遲直方圖也不會互相覆蓋。
+    依鍵的順序寫入，避免兩個 worker 以相反順序鎖定而死結。
+    """
+    rollups = ConversationRollup.__table__
+    for key in sorted(totals):
+        granularity, start, category, intent = key
+        target = totals[key]
+
+        new_users = 0
+        if category == TOTAL and target.users:
+            stmt = _insert(RollupUser.__table__).values([
+                {"granularity": granularity, "bucket_start": start, "user_id": user_id}
+                for user_id in sorted(target.users)
+            ]).on_conflict_do_nothing(index_elements=["granularity", "bucket_start", "user_id"])
+            new_users = len(db.session.execute(stmt.returning(RollupUser.__table__.c.user_id)).all())
+
+        stmt = _insert(rollups).values(
+            granularity=granularity, bucket_start=start, category=category, intent=intent,
+            conversations=target.conversations, followups=target.followups,
+            prompt_tokens=target.prompt_tokens, completion_tokens=target.completion_tokens,
+            total_tokens=target.total_tokens, cached_tokens=target.cached_tokens,
+            latency_ms_total=target.latency_ms_total, active_users=new_users,
+            # 新列先寫入空直方圖，與既有列走同一條合併路徑
+            latency_histogram="[]"
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(ROLLUP_KEY),
+            set_={column: func.coalesce(rollups.c[column], 0) + stmt.excluded[column] for column in ROLLUP_COUNTERS}
+        ).returning(rollups.c.id, rollups.c.latency_histogram)
+        rollup_id, stored = db.session.execute(stmt).one()
+
+        histogram = json.loads(stored) or [0] * len(target.histogram)
+        db.session.execute(
+            update(rollups).where(rollups.c.id == rollup_id)
+            .values(latency_histogram=json.dumps([a + b for a, b in zip(histogram, target.histogram)]))
+        )
+
+def add_conversations(conversations):
+    """
+    將一批對話累加到 rollup，先在記憶體中依統計區間彙總；不提交，
+    讓呼叫端把寫入對話與更新 rollup 放在同一個交易中。
+    """
+    totals = defaultdict(_Totals)
+    for conversation in conversations:
+        _accumulate(totals, conversation, GRANULARITIES)
+    _apply_totals(totals)
+
+def rebuild_rollups(start=None, end=None, chunk_size=1000):
+    """
+    從 conversations 重新計算 rollup。start/end 為日期（含 end 當天），
+    未指定則重建全部；總計（all）列一律由每日 rollup 重新彙總。
+    """
+    with app.app_context():
+        query = select(Conversation).order_by(Conversation.id)
+        rollup_filter = [ConversationRollup.granularity.in_(("hour", "day"))]
+        user_filter = [RollupUser.granularity.in_(("hour", "day"))]
+        if start:
+            start_dt = datetime.datetime.combine(start, datetime.time.min)
+            query = query.where(Conversation.timestamp >= start_dt)
+            rollup_filter.append(ConversationRollup.bucket_start >= start_dt)
+            user_filter.append(RollupUser.bucket_start >= start_dt)
+        if end:
+            end_dt = datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time.min)
+            query = query.where(Conversation.timestamp < end_dt)
+            rollup_filter.append(ConversationRollup.bucket_start < end_dt)
+            user_filter.append(RollupUser.bucket_start < end_dt)
+
+        totals = defaultdict(_Totals)
+        result = db.session.execute(query.execution_options(stream_results=True, yield_per=chunk_size))
+        count = 0
+        for conversation in result.scalars():
+            count += 1
+            _accumulate(totals, conversation, ("hour", "day"))
+
+        db.session.query(ConversationRollup).filter(*rollup_filter).delete(synchronize_session=False)
+        db.session.query(RollupUser).filter(*user_filter).delete(synchronize_session=False)
+        for (granularity, bucket, category, intent), target in totals.items():
+            db.session.add(_to_rollup(granularity, bucket, category, intent, target))
+            for user_id in target.users:
+                db.session.add(RollupUser(granularity=granularity, bucket_start=bucket, user_id=user_id))
+        db.session.flush()
+
+        _rebuild_all_time()
+        db.session.commit()
+        logger.info("已重建 %d 筆對話的統計", count)
+        return count
+
+def _to_rollup(granularity, bucket, category, intent, target):
+    return ConversationRollup(
+        granularity=granularity, bucket_start=bucket, category=category, intent=intent,
+        conversations=target.conversations, followups=target.followups,
+        prompt_tokens=target.prompt_tokens, completion_tokens=target.completion_tokens,
+        total_tokens=target.total_tokens, cached_tokens=target.cached_tokens,
+        latency_ms_total=target.latency_ms_total,
+        latency_histogram=json.dumps(target.histogram),
+        active_users=len(target.users) if category == TOTAL else 0
+    )
+
+def _rebuild_all_time():
+    """由每日 rollup 彙總出總計列，活躍使用者數則取對話中不重複的使用者"""
+    totals = defaultdict(_Totals)
+    for rollup in ConversationRollup.query.filter_by(granularity="day"):
+        target = totals[(rollup.category, rollup.intent)]
+        target.conversations += rollup.conversations
+        target.followups += rollup.followups
+        target.prompt_tokens += rollup.prompt_tokens
+        target.completion_tokens += rollup.completion_tokens
+        target.total_tokens += rollup.total_tokens
+        target.cached_tokens += rollup.cached_tokens or 0
+        target.latency_ms_total += rollup.latency_ms_total
+        for index, value in enumerate(json.loads(rollup.latency_histogram)):
+            target.histogram[index] += value
+
+    user_ids = [row[0] for row in db.session.execute(select(Conversation.user_id).distinct())]
+    totals[(TOTAL, TOTAL)].users.update(user_ids)
+
+    db.session.query(ConversationRollup).filter_by(granularity="all").delete(synchronize_session=False)
+    db.session.query(RollupUser).filter_by(granularity="all").delete(synchronize_session=False)
+    for (category, intent), target in totals.items():
+        db.session.add(_to_rollup("all", ALL_TIME, category, intent, target))
+    for user_id in user_ids:
+        db.session.add(RollupUser(granularity="all", bucket_start=ALL_TIME, user_id=user_id))
+
+def ensure_rollups():
+    """
+    rollup 表在既有資料庫升級時才建立，內容是空的，管理後台的總數只會計入之後的對話；
+    rollup 表為空但已有對話時，從對話重建全部統計。回傳重建的對話筆數。
+    每個 gunicorn worker 啟動時都會呼叫，以檔案鎖讓同一主機上只有一個 worker 重建，
+    其他 worker 等到重建完成後看到 rollup 已有資料便略過。
+    """
+    with app.app_context():
+        if db.session.scalar(select(ConversationRollup.id).limit(1)) is not None:
+            return 0
+        with open(ROLLUP_REBUILD_LOCK, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # 等待期間另一個 worker 可能已重建完成；結束目前的讀取交易才看得到
+            db.session.rollback()
+            if db.session.scalar(select(ConversationRollup.id).limit(1)) is not None:
+                return 0
+            if db.session.scalar(select(Conversation.id).limit(1)) is None:
+                return 0
+            logger.info("Rollup 表為空，從既有對話重建統計")
+            return rebuild_rollups()
+
+def dashboard_stats(now=None):
+    """
+    讀取管理後台需要的統計，只查 rollup 表，成本與對話總數無關。
+    """
+    now = now or datetime.datetime.utcnow()
+    today = bucket_start("day", now)
+
+    def total_row(granularity, start):
+        return ConversationRollup.query.filter_by(
+            granularity=granularity, bucket_start=start, category=TOTAL, intent=TOTAL
+        ).first()
+
+    breakdown = ConversationRollup.query.filter(
+        ConversationRollup.granularity == "day",
+        ConversationRollup.bucket_start == today,
+        ConversationRollup.category != TOTAL
+    ).order_by(ConversationRollup.conversations.desc()).all()
+
+    return {
+        "all_time": total_row("all", ALL_TIME),
+        "today": total_row("day", today),
+        "today_breakdown": breakdown,
+    }
+
+def prompt_cache_stats(days=7, now=None):
+    """
+    依分類彙總最近 days 天的 prompt 快取命中情形，比較有無命中時的延遲與 token 成本。
+    只計入實際呼叫 OpenAI 的對話（回覆快取命中、合併與失敗的對話沒有 prompt token），
+    並依 cached_tokens 是否大於 0 分成 hit / miss 兩組；rollup 沒有區分兩組，因此直接彙總對話表。
+    """
+    now = now or datetime.datetime.utcnow()
+    since = bucket_start("day", now) - datetime.timedelta(days=days - 1)
+    hit = func.coalesce(Conversation.cached_tokens, 0) > 0
+    rows = db.session.query(
+        Conversation.category,
+        hit,
+        func.count(),
+        func.sum(Conversation.prompt_tokens),
+        func.sum(func.coalesce(Conversation.cached_tokens, 0)),
+        func.sum(func.coalesce(Conversation.latency_ms, 0)),
+    ).filter(
+        Conversation.timestamp >= since,
+        Conversation.intent == "professional",
+        Conversation.prompt_tokens > 0
+    ).group_by(Conversation.category, hit)
+
+    stats = defaultdict(lambda: {"hit": _prompt_cache_group(0, 0, 0, 0), "miss": _prompt_cache_group(0, 0, 0, 0)})
+    for category, is_hit, conversations, prompt_tokens, cached_tokens, latency_ms_total in rows:
+        stats[category or "N/A"]["hit" if is_hit else "miss"] = _prompt_cache_group(
+            conversations, prompt_tokens or 0, cached_tokens or 0, latency_ms_total or 0
+        )
+    for group in stats.values():
+        prompt_tokens = group["hit"]["prompt_tokens"] + group["miss"]["prompt_tokens"]
+        group["cache_hit_rate"] = round(group["hit"]["cached_tokens"] / prompt_tokens, 3) if prompt_tokens else 0.0
+    return dict(sorted(stats.items()))
+
+def _prompt_cache_group(conversations, prompt_tokens, cached_tokens, latency_ms_total):
+    """單一組的平均值；billed_prompt_tokens 以快取 token 的折扣價換算成一般 prompt token"""
+    billed = prompt_tokens - cached_tokens + cached_tokens * CACHED_TOKEN_PRICE_RATIO
+    return {
+        "conversations": conversations,
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "avg_prompt_tokens": round(prompt_tokens / conversations) if conversations else 0,
+        "avg_billed_prompt_tokens": round(billed / conversations) if conversations else 0,
+        "avg_latency_ms": round(latency_ms_total / conversations) if conversations else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重建對話統計 rollup")
+    parser.add_argument("--start", type=lambda v: datetime.datetime.strptime(v, "%Y-%m-%d").date())
+    parser.add_argument("--end", type=lambda v: datetime.datetime.strptime(v, "%Y-%m-%d").date())
+    args = parser.parse_args()
+    rebuild_rollups(args.start, args.end)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
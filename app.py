@@ -1,18 +1,22 @@
 import os
 import logging
-import datetime
-from flask import Flask, request, abort, render_template, jsonify, redirect, url_for
+import threading
+import contextvars
+from flask import Flask, request, abort, render_template, jsonify, redirect, url_for, Response, stream_with_context
 from markupsafe import Markup
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
-from openai_service import generate_response
-import traceback
+from openai_service import generate_response_with_metadata
+from cache import get_cache
+from logging_config import setup_logging, new_request_id, new_correlation_id, SAMPLED
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 
 # Setup logging
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Base class for SQLAlchemy models
@@ -29,9 +33,17 @@ app.secret_key = os.environ.get("SESSION_SECRET")
 # Configure database - Using SQLite for simplicity
 import os.path
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(basedir, "app.db")
+# Opt in to another database with APP_DATABASE_URL. DATABASE_URL is deliberately not read: hosts
+# that set it for other tools would otherwise move the app off its existing app.db data.
+database_url = os.environ.get("APP_DATABASE_URL") or "sqlite:///" + os.path.join(basedir, "app.db")
+# Heroku-style postgres:// URLs are not accepted by SQLAlchemy, and a bare postgresql:// picks
+# whichever driver SQLAlchemy defaults to; use the psycopg2 driver this project depends on
+database_url = make_url(database_url)
+if database_url.drivername in ("postgres", "postgresql"):
+    database_url = database_url.set(drivername="postgresql+psycopg2")
+app.config["SQLALCHEMY_DATABASE_URI"] = database_url.render_as_string(hide_password=False)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-logger.info("Database configuration successful using SQLite")
+logger.info("Database configuration successful using %s", database_url.get_backend_name())
 
 # Initialize the database with the app
 db.init_app(app)
@@ -52,6 +64,9 @@ CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET")
 line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(CHANNEL_SECRET)
 
+# How long a LINE user id -> database id mapping stays cached (seconds)
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "3600"))
+
 # LINE Bot credentials
 
 @app.route("/")
@@ -62,21 +77,22 @@ def index():
 @app.route("/dashboard")
 def dashboard():
     """Display admin dashboard."""
-    from models import User, Conversation
-    import datetime
+    from models import User
+    from analytics import dashboard_stats
     
     users = User.query.all()
-    total_conversations = Conversation.query.count()
     
-    # Calculate active users today
-    today_start = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    active_today = User.query.filter(User.last_interaction >= today_start).count()
+    # Conversation statistics come from the rollup tables, not a scan of conversations
+    stats = dashboard_stats()
+    total_conversations = stats["all_time"].conversations if stats["all_time"] else 0
+    active_today = stats["today"].active_users if stats["today"] else 0
     
     return render_template(
         "dashboard.html", 
         users=users, 
         total_conversations=total_conversations, 
-        active_today=active_today
+        active_today=active_today,
+        stats=stats
     )
 
 @app.route("/user/<int:user_id>")
@@ -111,7 +127,7 @@ def update_user(user_id):
     
     # Save changes
     db.session.commit()
-    logger.debug(f"Updated user: {user}")
+    logger.debug("Updated user: %s", user)
     
     return redirect(url_for("view_user", user_id=user.id))
 
@@ -123,17 +139,25 @@ def webhook():
     
     # Get request body as text
     body = request.get_data(as_text=True)
-    logger.debug(f"Request body: {body}")
+    new_request_id()
+    logger.debug("Request body: %s", body, extra=SAMPLED)
     
     try:
-        # Handle webhook body
-        handler.handle(body, signature)
+        from debounce import DEBOUNCE_SYNC_SECONDS
+        if DEBOUNCE_SYNC_SECONDS > 0:
+            events = handler.parser.parse(body, signature)
+            dispatch_delivery([
+                event for event in events
+                if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+            ])
+        else:
+            # Handle webhook body
+            handler.handle(body, signature)
     except InvalidSignatureError:
         logger.error("Invalid signature")
         abort(400)
     except Exception as e:
-        logger.error(f"Error: {e}")
-        traceback.print_exc()
+        logger.exception("Error: %s", e)
         abort(500)
     
     return "OK"
@@ -143,6 +167,23 @@ def health_check():
     """Health check endpoint."""
     return jsonify({"status": "healthy"}), 200
 
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    """Per-namespace cache statistics."""
+    return jsonify(get_cache().stats()), 200
+
+@app.route("/stats/prompt-cache", methods=["GET"])
+def prompt_cache_stats():
+    """Per-category OpenAI prompt cache hit rate over the last ?days= days."""
+    from analytics import prompt_cache_stats as collect_stats
+    return jsonify(collect_stats(days=request.args.get("days", 7, type=int))), 200
+
+@app.route("/journal/stats", methods=["GET"])
+def journal_stats():
+    """Conversation journal queue depth and flush lag."""
+    from conversation_journal import get_journal
+    return jsonify(get_journal().stats()), 200
+
 @app.route("/daily-summary", methods=["GET"])
 def view_daily_summaries():
     """查看每日摘要列表"""
@@ -173,62 +214,201 @@ def generate_summary():
     result = manual_run_task()
     return jsonify({"status": "success", "message": result}), 200
 
+@app.route("/export/<dataset>", methods=["GET"])
+def export_data(dataset):
+    """Stream conversations or daily summaries as CSV, JSONL or Parquet."""
+    from export import (EXPORT_FORMATS, PARQUET_MISSING, CONVERSATION_COLUMNS, SUMMARY_COLUMNS,
+                        parse_date, conversation_query, summary_query, stream_export)
+    
+    fmt = request.args.get("format", "csv")
+    if dataset not in ("conversations", "summaries"):
+        abort(404)
+    if fmt == "parquet" and fmt not in EXPORT_FORMATS:
+        return jsonify({"status": "error", "message": PARQUET_MISSING}), 400
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+    
+    try:
+        start = parse_date(request.args.get("start"))
+        end = parse_date(request.args.get("end"))
+    except ValueError:
+        abort(400)
+    
+    if dataset == "conversations":
+        query = conversation_query(
+            start, end,
+            user_id=request.args.get("user_id", type=int),
+            industry=request.args.get("industry"),
+            role=request.args.get("role")
+        )
+        columns = CONVERSATION_COLUMNS
+    else:
+        query = summary_query(start, end)
+        columns = SUMMARY_COLUMNS
+    
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    return Response(
+        stream_with_context(stream_export(query, columns, fmt)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={dataset}.{extension}"}
+    )
+
+def lookup_user_id(line_user_id):
+    """
+    Return the database id of a known LINE user, or None if the user has not
+    been seen before. Reads only: last_interaction is advanced by the
+    conversation journal when the message's batch is committed.
+    """
+    from models import User
+    cache = get_cache()
+    user_id = cache.get("users", line_user_id)
+    if user_id is not None:
+        return user_id
+    
+    user_id = User.query.with_entities(User.id).filter_by(line_user_id=line_user_id).scalar()
+    if user_id is None:
+        return None
+    cache.set("users", line_user_id, user_id, ttl=USER_CACHE_TTL)
+    return user_id
+
+def create_user(line_user_id, display_name=None):
+    """
+    Create a user for a new LINE user id and return the database id. If another
+    request created the same user first, return that user's id instead.
+    """
+    from models import User
+    user = User(line_user_id=line_user_id, display_name=display_name)
+    db.session.add(user)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Several events from a new user in one webhook are handled concurrently
+        db.session.rollback()
+        user_id = lookup_user_id(line_user_id)
+        if user_id is None:
+            raise
+        return user_id
+    logger.debug("Created new user: %s", user)
+    get_cache().set("users", line_user_id, user.id, ttl=USER_CACHE_TTL)
+    return user.id
+
+def save_conversations(user_id, messages, ai_response, metadata):
+    """
+    Journal every message of a burst with its own timestamp. The reply and the
+    pipeline metadata belong to the last message; earlier ones are marked as
+    merged and have no reply of their own.
+    """
+    from conversation_journal import get_journal
+    journal = get_journal()
+    for message in messages[:-1]:
+        journal.append(
+            user_id=user_id,
+            user_message=message.text,
+            bot_response="",
+            merged=True,
+            timestamp=message.timestamp
+        )
+    return journal.append(
+        user_id=user_id,
+        user_message=messages[-1].text,
+        bot_response=ai_response,
+        timestamp=messages[-1].timestamp,
+        **metadata
+    )
+
+def send_reply(line_user_id, reply_token, text):
+    """Reply with the given token, falling back to a push if the token is no longer valid."""
+    try:
+        line_bot_api.reply_message(reply_token, TextSendMessage(text=text))
+    except LineBotApiError as e:
+        logger.warning("Reply failed (%s), sending as push message", e.status_code)
+        line_bot_api.push_message(line_user_id, TextSendMessage(text=text))
+
+# Set in the threads of dispatch_delivery(); handle_text_message() sets it once its message is in a burst
+_submitted = contextvars.ContextVar("submitted", default=None)
+
+def dispatch_delivery(events):
+    """
+    Handle the text events of one webhook delivery side by side, as the async
+    server does with gather(). Handled one after another, the burst leader
+    would sleep out its whole window before the next event of the same
+    delivery was submitted, so they would never merge and the response would
+    wait one window per event.
+    """
+    threads, errors = [], []
+    for event in events:
+        submitted = threading.Event()
+        thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(_handle_delivery_event, event, submitted, errors)
+        )
+        thread.start()
+        threads.append(thread)
+        # Start the next event only once this one is in a burst, so a burst keeps the delivery's order
+        submitted.wait()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def _handle_delivery_event(event, submitted, errors):
+    _submitted.set(submitted)
+    try:
+        # Each thread needs its own app context, and so its own database session
+        with app.app_context():
+            handle_text_message(event)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        submitted.set()
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_text_message(event):
     """Handle text message from LINE."""
+    reply_token = event.reply_token
     try:
         user_message = event.message.text
         line_user_id = event.source.user_id
-        logger.debug(f"Received message from {line_user_id}: {user_message}")
+        new_correlation_id(getattr(event, "webhook_event_id", None))
+        logger.debug("Received message from %s: %s", line_user_id, user_message, extra=SAMPLED)
         
         # Check if the user exists in the database, otherwise create
-        from models import User, Conversation
-        user = User.query.filter_by(line_user_id=line_user_id).first()
-        
-        if not user:
+        user_id = lookup_user_id(line_user_id)
+        if user_id is None:
             # Try to get user profile from LINE
             try:
-                profile = line_bot_api.get_profile(line_user_id)
-                user = User(
-                    line_user_id=line_user_id,
-                    display_name=profile.display_name
-                )
+                display_name = line_bot_api.get_profile(line_user_id).display_name
             except Exception as profile_error:
-                logger.error(f"Error getting user profile: {profile_error}")
-                user = User(line_user_id=line_user_id)
-            
-            db.session.add(user)
-            db.session.commit()
-            logger.debug(f"Created new user: {user}")
-        else:
-            # Update last interaction time
-            user.last_interaction = datetime.datetime.utcnow()
-            db.session.commit()
+                logger.error("Error getting user profile: %s", profile_error)
+                display_name = None
+            user_id = create_user(line_user_id, display_name)
+        
+        # Messages sent in quick succession are answered once, by the handler of the first one
+        from debounce import get_debouncer, merge_messages
+        debouncer = get_debouncer(blocking=True)
+        burst = debouncer.submit(line_user_id, user_message, reply_token)
+        if _submitted.get() is not None:
+            _submitted.get().set()
+        if burst is None:
+            logger.debug("Message merged into a pending burst")
+            return
+        messages = debouncer.wait(line_user_id, burst)
+        reply_token = messages[-1].reply_token
         
         # Generate response using OpenAI
-        ai_response = generate_response(user_message)
-        logger.debug(f"AI response: {ai_response}")
+        ai_response, metadata = generate_response_with_metadata(merge_messages(messages))
+        logger.debug("AI response: %s", ai_response, extra=SAMPLED)
         
-        # Save conversation
-        conversation = Conversation(
-            user_id=user.id,
-            user_message=user_message,
-            bot_response=ai_response
-        )
-        db.session.add(conversation)
-        db.session.commit()
-        logger.debug(f"Saved conversation: {conversation}")
+        # Journal the conversations; the flusher inserts them in a batch and updates the rollups
+        journal_id = save_conversations(user_id, messages, ai_response, metadata)
+        logger.debug("Journaled %d messages, last %s", len(messages), journal_id)
         
-        # Send response back to LINE
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=ai_response)
-        )
+        # Send response back to LINE with the newest reply token
+        send_reply(line_user_id, reply_token, ai_response)
     except Exception as e:
-        logger.error(f"Error processing message: {e}")
-        traceback.print_exc()
+        logger.exception("Error processing message: %s", e)
         line_bot_api.reply_message(
-            event.reply_token,
+            reply_token,
             TextSendMessage(text="抱歉，我暫時無法處理您的訊息。請稍後再試。")
         )
 
@@ -0,0 +1,144 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from aiohttp import web
+from linebot import AsyncLineBotApi, WebhookParser
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.models import MessageEvent, TextMessage, TextSendMessage
+# main creates the tables and replays the conversation journal, as for the Flask app
+from main import app as flask_app
+from app import lookup_user_id, create_user, save_conversations, CHANNEL_ACCESS_TOKEN, CHANNEL_SECRET
+from debounce import get_debouncer, merge_messages
+from openai_service import generate_response_with_metadata_async
+from logging_config import new_request_id, new_correlation_id, SAMPLED
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Threads for blocking work (database, cache, journal, keyword routing); LLM calls do not use them
+ASYNC_EXECUTOR_THREADS = int(os.environ.get("ASYNC_EXECUTOR_THREADS", "16"))
+ASYNC_PORT = int(os.environ.get("PORT", "5000"))
+
+parser = WebhookParser(CHANNEL_SECRET)
+
+
+def _in_app_context(func, *args, **kwargs):
+    with flask_app.app_context():
+        return func(*args, **kwargs)
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a database-bound function on the executor inside a Flask app context."""
+    return await asyncio.to_thread(_in_app_context, func, *args, **kwargs)
+
+
+async def send_reply(line_bot_api, line_user_id, reply_token, text):
+    """Coroutine version of app.send_reply."""
+    try:
+        await line_bot_api.reply_message(reply_token, TextSendMessage(text=text))
+    except LineBotApiError as e:
+        logger.warning("Reply failed (%s), sending as push message", e.status_code)
+        await line_bot_api.push_message(line_user_id, TextSendMessage(text=text))
+
+async def handle_text_message(event, line_bot_api):
+    """Coroutine version of app.handle_text_message."""
+    reply_token = event.reply_token
+    try:
+        user_message = event.message.text
+        line_user_id = event.source.user_id
+        new_correlation_id(getattr(event, "webhook_event_id", None))
+        logger.debug("Received message from %s: %s", line_user_id, user_message, extra=SAMPLED)
+
+        # Check if the user exists in the database, otherwise create
+        user_id = await run_blocking(lookup_user_id, line_user_id)
+        if user_id is None:
+            # Try to get user profile from LINE
+            try:
+                display_name = (await line_bot_api.get_profile(line_user_id)).display_name
+            except Exception as profile_error:
+                logger.error("Error getting user profile: %s", profile_error)
+                display_name = None
+            user_id = await run_blocking(create_user, line_user_id, display_name)
+
+        # Messages sent in quick succession are answered once, by the handler of the first one
+        debouncer = get_debouncer()
+        burst = debouncer.submit(line_user_id, user_message, reply_token)
+        if burst is None:
+            logger.debug("Message merged into a pending burst")
+            return
+        messages = await debouncer.wait_async(line_user_id, burst)
+        reply_token = messages[-1].reply_token
+
+        # Generate response using AsyncOpenAI
+        ai_response, metadata = await generate_response_with_metadata_async(merge_messages(messages))
+        logger.debug("AI response: %s", ai_response, extra=SAMPLED)
+
+        # Journal the conversations; the flusher inserts them in a batch and updates the rollups
+        journal_id = await run_blocking(save_conversations, user_id, messages, ai_response, metadata)
+        logger.debug("Journaled %d messages, last %s", len(messages), journal_id)
+
+        # Send response back to LINE with the newest reply token
+        await send_reply(line_bot_api, line_user_id, reply_token, ai_response)
+    except Exception as e:
+        logger.exception("Error processing message: %s", e)
+        await line_bot_api.reply_message(
+            reply_token,
+            TextSendMessage(text="抱歉，我暫時無法處理您的訊息。請稍後再試。")
+        )
+
+async def webhook(request):
+    """Handle webhook requests from LINE; all events of a request are processed concurrently."""
+    signature = request.headers.get("X-Line-Signature", "")
+    body = await request.text()
+    new_request_id()
+    logger.debug("Request body: %s", body, extra=SAMPLED)
+
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        logger.error("Invalid signature")
+        raise web.HTTPBadRequest()
+
+    line_bot_api = request.app["line_bot_api"]
+    await asyncio.gather(*(
+        handle_text_message(event, line_bot_api)
+        for event in events
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+    ))
+    return web.Response(text="OK")
+
+async def health_check(request):
+    """Health check endpoint."""
+    return web.json_response({"status": "healthy"})
+
+
+async def _on_startup(application):
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(ASYNC_EXECUTOR_THREADS, thread_name_prefix="async-app")
+    )
+    application["http_session"] = aiohttp.ClientSession()
+    application["line_bot_api"] = AsyncLineBotApi(
+        CHANNEL_ACCESS_TOKEN, AiohttpAsyncHttpClient(application["http_session"])
+    )
+
+async def _on_cleanup(application):
+    await application["http_session"].close()
+
+async def create_app():
+    """
+    aiohttp application serving the LINE webhook on one event loop.
+    Run with `python async_app.py` or
+    `gunicorn async_app:create_app --worker-class aiohttp.GunicornWebWorker`.
+    """
+    application = web.Application()
+    application.router.add_post("/webhook", webhook)
+    application.router.add_get("/health", health_check)
+    application.on_startup.append(_on_startup)
+    application.on_cleanup.append(_on_cleanup)
+    return application
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=ASYNC_PORT)
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from linebot.exceptions import LineBotApiError
+from app import app, db
+from models import User, DailySummary, BroadcastJob, BroadcastBatch
+from line_bot import send_multicast, MULTICAST_LIMIT
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 同時進行的 multicast 呼叫數與每秒呼叫上限（LINE multicast 上限為 200 次/秒）
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_RATE_LIMIT = float(os.environ.get("BROADCAST_RATE_LIMIT", "100"))
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get("BROADCAST_MAX_ATTEMPTS", "5"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# LINE 只在第一次使用 retry key 後 24 小時內去除重複請求，保留一小時餘裕
+RETRY_KEY_MAX_AGE = datetime.timedelta(hours=23)
+
+
+class RateLimiter:
+    """讓多個執行緒合計每秒呼叫次數不超過 rate"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def select_recipients(industry=None, role=None):
+    """依產業、角色篩選要推播的 LINE user id"""
+    query = db.session.query(User.line_user_id)
+    if industry:
+        query = query.filter(User.industry == industry)
+    if role:
+        query = query.filter(User.role == role)
+    return [row[0] for row in query.order_by(User.id)]
+
+def create_broadcast(message, user_ids):
+    """建立推播工作，並將收件人切成每批最多 MULTICAST_LIMIT 人"""
+    job = BroadcastJob(message=message, status="pending", total_recipients=len(user_ids))
+    db.session.add(job)
+    db.session.flush()
+    for index, start in enumerate(range(0, len(user_ids), MULTICAST_LIMIT)):
+        recipients = user_ids[start:start + MULTICAST_LIMIT]
+        db.session.add(BroadcastBatch(
+            job_id=job.id,
+            batch_index=index,
+            recipients=json.dumps(recipients),
+            recipient_count=len(recipients),
+            retry_key=str(uuid.uuid4()),
+            status="pending",
+            attempts=0
+        ))
+    db.session.commit()
+    logger.info("建立推播工作 %d：%d 位收件人", job.id, len(user_ids))
+    return job
+
+def _backoff(attempt, retry_after=None):
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+    return min(BACKOFF_BASE_SECONDS * 2 ** attempt, BACKOFF_MAX_SECONDS) * random.uniform(0.5, 1.0)
+
+def _deliver(recipients, message, retry_key, limiter):
+    """
+    送出一批 multicast，遇到 429 / 5xx / 連線錯誤時退避重試。
+    在背景執行緒中執行，不碰資料庫；回傳 (status, attempts, request_id, error)。
+    """
+    error = None
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        limiter.wait()
+        try:
+            request_id = send_multicast(recipients, message, retry_key=retry_key)
+            return "sent", attempt + 1, request_id, None
+        except LineBotApiError as e:
+            error = f"{e.status_code}: {e.error.message}" if e.error else str(e.status_code)
+            if e.status_code == 409:
+                # 相同 retry key 的請求已被接受過（例如上次中斷前已送出）
+                return "sent", attempt + 1, e.accepted_request_id, None
+            if e.status_code != 429 and e.status_code < 500:
+                return "failed", attempt + 1, e.request_id, error
+            delay = _backoff(attempt, (e.headers or {}).get("Retry-After"))
+        except Exception as e:
+            error = str(e)
+            delay = _backoff(attempt)
+        if attempt + 1 == BROADCAST_MAX_ATTEMPTS:
+            break
+        logger.warning("multicast 失敗（第 %d 次）：%s，%.1f 秒後重試", attempt + 1, error, delay)
+        time.sleep(delay)
+    logger.warning("multicast 失敗 %d 次，放棄：%s", BROADCAST_MAX_ATTEMPTS, error)
+    return "failed", BROADCAST_MAX_ATTEMPTS, None, error
+
+def _check_retry_keys(job, batches, regenerate_expired, now):
+    """
+    retry key 第一次送出超過 RETRY_KEY_MAX_AGE 的批次，LINE 已不會擋下重複請求，
+    若先前其實已送達，重送會重複推播。預設將這些批次標為 expired 並略過；
+    regenerate_expired 時改用新的 retry key 重送。回傳可以送出的批次。
+    """
+    ready = []
+    for batch in batches:
+        # 沒有記錄使用時間的舊批次，若工作曾經執行過，保守地以建立時間估計
+        used_at = batch.retry_key_used_at or (job.created_at if job.status != "pending" else None)
+        if used_at and now - used_at > RETRY_KEY_MAX_AGE:
+            if not regenerate_expired:
+                batch.status = "expired"
+                batch.error = "retry key 已超過 24 小時，可能已送達；確認後以 --regenerate-expired 重送"
+                continue
+            logger.warning("批次 %d 的 retry key 已過期，改用新的 retry key（可能重複推播）", batch.batch_index)
+            batch.retry_key = str(uuid.uuid4())
+            batch.retry_key_used_at = None
+        if batch.retry_key_used_at is None:
+            batch.retry_key_used_at = now
+        ready.append(batch)
+    return ready
+
+def run_broadcast(job_id, retry_failed=False, regenerate_expired=False,
+                  concurrency=BROADCAST_CONCURRENCY, rate_limit=BROADCAST_RATE_LIMIT):
+    """
+    執行（或接續執行）推播工作。只處理尚未成功的批次，每批結果送達後立即寫入資料庫，
+    中斷後再次執行會從未完成的批次繼續；已送出的批次以相同 retry key 重送也不會重複推播。
+    retry key 只在 24 小時內有效，超過時間的批次見 _check_retry_keys。
+    """
+    job = db.session.get(BroadcastJob, job_id)
+    if job is None:
+        raise ValueError(f"Broadcast job {job_id} not found")
+
+    statuses = ["pending"]
+    if retry_failed:
+        statuses.append("failed")
+    if regenerate_expired:
+        statuses.append("expired")
+    batches = BroadcastBatch.query.filter(
+        BroadcastBatch.job_id == job_id,
+        BroadcastBatch.status.in_(statuses)
+    ).order_by(BroadcastBatch.batch_index).all()
+    # 送出前先記下 retry key 的使用時間，中斷後接續時才能判斷是否過期
+    batches = _check_retry_keys(job, batches, regenerate_expired, datetime.datetime.utcnow())
+
+    job.status = "running"
+    db.session.commit()
+    logger.info("推播工作 %d：待送 %d 批", job_id, len(batches))
+
+    limiter = RateLimiter(rate_limit)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(_deliver, json.loads(batch.recipients), job.message, batch.retry_key, limiter): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            status, attempts, request_id, error = future.result()
+            batch.status = status
+            batch.attempts += attempts
+            batch.request_id = request_id
+            batch.error = error
+            batch.sent_at = datetime.datetime.utcnow() if status == "sent" else None
+            db.session.commit()
+
+    remaining = BroadcastBatch.query.filter(
+        BroadcastBatch.job_id == job_id,
+        BroadcastBatch.status != "sent"
+    ).count()
+    job.status = "completed" if remaining == 0 else "partial"
+    job.finished_at = datetime.datetime.utcnow()
+    db.session.commit()
+    logger.info("推播工作 %d 結束：%s，未成功 %d 批", job_id, job.status, remaining)
+    return job_status(job_id)
+
+def job_status(job_id):
+    """彙整推播工作各批次的結果"""
+    job = db.session.get(BroadcastJob, job_id)
+    batches = BroadcastBatch.query.filter_by(job_id=job_id).order_by(BroadcastBatch.batch_index).all()
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "total_recipients": job.total_recipients,
+        "batches": len(batches),
+        "sent_batches": sum(1 for b in batches if b.status == "sent"),
+        "sent_recipients": sum(b.recipient_count for b in batches if b.status == "sent"),
+        "failed": [
+            {"batch_index": b.batch_index, "attempts": b.attempts, "error": b.error}
+            for b in batches if b.status == "failed"
+        ],
+        "expired": [b.batch_index for b in batches if b.status == "expired"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批次推播訊息給 LINE 使用者")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    send_parser = subparsers.add_parser("send", help="建立並執行新的推播")
+    send_parser.add_argument("message", nargs="?", help="訊息內容")
+    send_parser.add_argument("--daily-summary", metavar="YYYY-MM-DD", nargs="?", const="today",
+                             help="推播指定日期（預設今天）的每日摘要")
+    send_parser.add_argument("--industry")
+    send_parser.add_argument("--role")
+    send_parser.add_argument("--concurrency", type=int, default=BROADCAST_CONCURRENCY)
+
+    resume_parser = subparsers.add_parser("resume", help="接續執行未完成的推播")
+    resume_parser.add_argument("job_id", type=int)
+    resume_parser.add_argument("--retry-failed", action="store_true", help="一併重送失敗的批次")
+    resume_parser.add_argument("--regenerate-expired", action="store_true",
+                               help="retry key 超過 24 小時的批次改用新的 key 重送（若先前已送達會重複推播）")
+    resume_parser.add_argument("--concurrency", type=int, default=BROADCAST_CONCURRENCY)
+
+    status_parser = subparsers.add_parser("status", help="查看推播結果")
+    status_parser.add_argument("job_id", type=int)
+
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.command == "send":
+            message = args.message
+            if args.daily_summary:
+                if args.daily_summary == "today":
+                    summary_date = datetime.datetime.now().date()
+                else:
+                    summary_date = datetime.datetime.strptime(args.daily_summary, "%Y-%m-%d").date()
+                summary = DailySummary.query.filter_by(summary_date=summary_date).first()
+                if summary is None:
+                    parser.error(f"{summary_date} 沒有每日摘要")
+                message = summary.summary_content
+            if not message:
+                parser.error("請提供訊息內容或 --daily-summary")
+            job = create_broadcast(message, select_recipients(args.industry, args.role))
+            result = run_broadcast(job.id, concurrency=args.concurrency)
+        elif args.command == "resume":
+            result = run_broadcast(args.job_id, retry_failed=args.retry_failed,
+                                   regenerate_expired=args.regenerate_expired, concurrency=args.concurrency)
+        else:
+            result = job_status(args.job_id)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,478 @@
+import os
+import time
+import atexit
+import pickle
+import sqlite3
+import inspect
+import logging
+import functools
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Cache configuration
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory")
+CACHE_URL = os.environ.get("CACHE_URL")
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "10000"))
+# Shared backends write buffered hit/miss counters at most this often
+CACHE_STATS_FLUSH_SECONDS = float(os.environ.get("CACHE_STATS_FLUSH_SECONDS", "5"))
+# Redis connect/read timeout; a slow or unreachable server is treated as a miss after this long
+CACHE_TIMEOUT_SECONDS = float(os.environ.get("CACHE_TIMEOUT_SECONDS", "0.5"))
+# Expiry for set() calls without a ttl, the same in every backend
+CACHE_DEFAULT_TTL = float(os.environ.get("CACHE_DEFAULT_TTL", str(24 * 3600)))
+
+STAT_FIELDS = ("hits", "misses", "sets", "deletes", "invalidations")
+
+
+def _fail_open(method):
+    """
+    Treat an unreachable or failing cache server as a miss: log a warning and
+    return the caller's default (get) or None (writes) instead of raising, so
+    a cache outage only costs the work the cache would have saved.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except self.backend_errors as e:
+            logger.warning("Cache %s failed, continuing without cache: %s", method.__name__, e)
+            arguments = signature.bind(self, *args, **kwargs)
+            arguments.apply_defaults()
+            return arguments.arguments.get("default")
+    return wrapper
+
+
+class BaseCache:
+    """
+    Common interface for all cache backends.
+
+    Every key lives inside a namespace (e.g. "users", "responses", "summaries")
+    so a whole group of entries can be invalidated at once and stats can be
+    reported per namespace. Values must be picklable. set() without a ttl
+    expires after CACHE_DEFAULT_TTL seconds in every backend. Shared backends
+    treat server errors as misses (see _fail_open).
+    """
+
+    # Errors from the backing store that are logged and treated as a miss
+    backend_errors = ()
+
+    def get(self, namespace, key, default=None):
+        raise NotImplementedError
+
+    def set(self, namespace, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        raise NotImplementedError
+
+    def invalidate(self, namespace):
+        """Drop every entry in a namespace."""
+        raise NotImplementedError
+
+    def stats(self, namespace=None):
+        """Return {namespace: {hits, misses, ...}} or the counters of one namespace."""
+        raise NotImplementedError
+
+    def get_or_set(self, namespace, key, factory, ttl=None):
+        """Return the cached value, computing and storing it with factory() on a miss."""
+        missing = object()
+        value = self.get(namespace, key, missing)
+        if value is missing:
+            value = factory()
+            self.set(namespace, key, value, ttl=ttl)
+        return value
+
+
+class MemoryCache(BaseCache):
+    """In-process LRU cache. Fast, but private to each worker."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, default_ttl=CACHE_DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()
+        self._stats = defaultdict(lambda: dict.fromkeys(STAT_FIELDS, 0))
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            item = self._data.get((namespace, key))
+            if item is not None:
+                value, expires_at = item
+                if expires_at is None or expires_at > time.time():
+                    self._data.move_to_end((namespace, key))
+                    self._stats[namespace]["hits"] += 1
+                    return value
+                del self._data[(namespace, key)]
+            self._stats[namespace]["misses"] += 1
+            return default
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + (ttl or self.default_ttl)
+        with self._lock:
+            self._data[(namespace, key)] = (value, expires_at)
+            self._data.move_to_end((namespace, key))
+            self._stats[namespace]["sets"] += 1
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            if self._data.pop((namespace, key), None) is not None:
+                self._stats[namespace]["deletes"] += 1
+
+    def invalidate(self, namespace):
+        with self._lock:
+            for cache_key in [k for k in self._data if k[0] == namespace]:
+                del self._data[cache_key]
+            self._stats[namespace]["invalidations"] += 1
+
+    def stats(self, namespace=None):
+        with self._lock:
+            if namespace is not None:
+                return dict(self._stats[namespace])
+            return {ns: dict(counters) for ns, counters in self._stats.items()}
+
+
+class _PendingStats:
+    """
+    Counters (and LRU touches) kept in memory and written to a shared store
+    in one batch, so reads do not need a write round trip of their own.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._touches = {}
+        self._flushed_at = time.monotonic()
+
+    def add(self, namespace, field, touch=None):
+        """Count one event; returns True once the buffer is due to be flushed."""
+        with self._lock:
+            self._counts[(namespace, field)] += 1
+            if touch is not None:
+                self._touches[(namespace, touch[0])] = touch[1]
+            return time.monotonic() - self._flushed_at >= self.interval
+
+    def take(self):
+        with self._lock:
+            counts, touches = self._counts, self._touches
+            self._counts, self._touches = Counter(), {}
+            self._flushed_at = time.monotonic()
+            return counts, touches
+
+    def restore(self, counts, touches):
+        # Put back what could not be written so it is retried with the next flush
+        with self._lock:
+            self._counts.update(counts)
+            for cache_key, accessed_at in touches.items():
+                self._touches.setdefault(cache_key, accessed_at)
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache stored in a SQLite file, shared by every process on the same host.
+
+    The file is opened in WAL mode with a memory-mapped read path, so reads
+    from several gunicorn workers do not block each other: a hit only reads.
+    Hit/miss counters and LRU access times are buffered per process and
+    written in one transaction every CACHE_STATS_FLUSH_SECONDS (and by every
+    set(), before it evicts).
+    """
+
+    backend_errors = (sqlite3.Error,)
+
+    def __init__(self, path=None, max_entries=CACHE_MAX_ENTRIES, mmap_size=64 * 1024 * 1024,
+                 flush_interval=CACHE_STATS_FLUSH_SECONDS, default_ttl=CACHE_DEFAULT_TTL):
+        basedir = os.path.abspath(os.path.dirname(__file__))
+        self.path = path or os.path.join(basedir, "cache.db")
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._pending = _PendingStats(flush_interval)
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE INDEX IF NOT EXISTS ix_cache_entries_accessed ON cache_entries (accessed_at);
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                namespace TEXT NOT NULL,
+                field TEXT NOT NULL,
+                value INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (namespace, field)
+            );
+        """)
+        atexit.register(self.flush)
+
+    def _conn(self):
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            self._local.conn = conn
+        return conn
+
+    def _bump(self, namespace, field, touch=None):
+        if self._pending.add(namespace, field, touch):
+            self.flush()
+
+    def _write_pending(self, conn, counts, touches):
+        # Called inside a write transaction
+        conn.executemany(
+            "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ? AND accessed_at < ?",
+            [(accessed_at, namespace, key, accessed_at) for (namespace, key), accessed_at in touches.items()]
+        )
+        conn.executemany(
+            "INSERT INTO cache_stats (namespace, field, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(namespace, field) DO UPDATE SET value = value + excluded.value",
+            [(namespace, field, n) for (namespace, field), n in counts.items()]
+        )
+
+    def flush(self):
+        """Write the buffered counters and access times of this process."""
+        counts, touches = self._pending.take()
+        if not counts and not touches:
+            return
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_pending(conn, counts, touches)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.warning("Cache stats flush failed, will retry: %s", e)
+            self._pending.restore(counts, touches)
+
+    @_fail_open
+    def get(self, namespace, key, default=None):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+            (namespace, str(key))
+        ).fetchone()
+        if row is not None and (row[1] is None or row[1] > now):
+            self._bump(namespace, "hits", touch=(str(key), now))
+            return pickle.loads(row[0])
+        if row is not None:
+            conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, str(key)))
+        self._bump(namespace, "misses")
+        return default
+
+    @_fail_open
+    def set(self, namespace, key, value, ttl=None):
+        conn = self._conn()
+        now = time.time()
+        expires_at = now + (ttl or self.default_ttl)
+        conn.execute("BEGIN IMMEDIATE")
+        counts, touches = self._pending.take()
+        try:
+            # 先寫入累積的存取時間，淘汰時才不會誤刪最近讀過的項目
+            self._write_pending(conn, counts, touches)
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (namespace, str(key), sqlite3.Binary(pickle.dumps(value)), expires_at, now)
+            )
+            # 超過上限時淘汰最久未使用的項目
+            conn.execute(
+                "DELETE FROM cache_entries WHERE rowid IN ("
+                "SELECT rowid FROM cache_entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            self._pending.restore(counts, touches)
+            raise
+        self._pending.add(namespace, "sets")
+
+    @_fail_open
+    def delete(self, namespace, key):
+        conn = self._conn()
+        cursor = conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, str(key)))
+        if cursor.rowcount:
+            self._bump(namespace, "deletes")
+
+    @_fail_open
+    def invalidate(self, namespace):
+        conn = self._conn()
+        conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (namespace,))
+        self._bump(namespace, "invalidations")
+
+    def stats(self, namespace=None):
+        # Counters buffered by other workers show up after their next flush
+        self.flush()
+        conn = self._conn()
+        result = defaultdict(lambda: dict.fromkeys(STAT_FIELDS, 0))
+        for ns, field, value in conn.execute("SELECT namespace, field, value FROM cache_stats"):
+            result[ns][field] = value
+        if namespace is not None:
+            return dict(result[namespace])
+        return {ns: dict(counters) for ns, counters in result.items()}
+
+
+class RedisCache(BaseCache):
+    """
+    Cache shared by every worker and host through a Redis-protocol server.
+
+    Namespaces are versioned: every value is stored together with the
+    namespace version it was written under, and invalidate() bumps the
+    version so older values read as misses at once and are left to expire,
+    instead of scanning the keyspace. A get() is one pipelined round trip
+    (version and value); counters are buffered per process and sent with
+    one pipeline every CACHE_STATS_FLUSH_SECONDS. Any client with the
+    redis-py API can be passed in (for example a local stand-in in
+    development).
+    """
+
+    backend_errors = (redis.RedisError,) if redis is not None else ()
+
+    def __init__(self, client=None, url=CACHE_URL, prefix="linebot", default_ttl=CACHE_DEFAULT_TTL,
+                 flush_interval=CACHE_STATS_FLUSH_SECONDS):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("redis package not installed. Please install it with 'pip install redis'.")
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0",
+                                          socket_connect_timeout=CACHE_TIMEOUT_SECONDS,
+                                          socket_timeout=CACHE_TIMEOUT_SECONDS)
+        self.client = client
+        self.prefix = prefix
+        # Every key expires, so values left behind by invalidate() are eventually dropped
+        self.default_ttl = default_ttl
+        self._pending = _PendingStats(flush_interval)
+        atexit.register(self.flush)
+
+    def _version_key(self, namespace):
+        return f"{self.prefix}:version:{namespace}"
+
+    def _key(self, namespace, key):
+        return f"{self.prefix}:entry:{namespace}:{key}"
+
+    def _bump(self, namespace, field):
+        if self._pending.add(namespace, field):
+            self.flush()
+
+    def flush(self):
+        """Send the buffered counters of this process in one pipeline."""
+        counts, _ = self._pending.take()
+        if not counts:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for (namespace, field), n in counts.items():
+            pipe.hincrby(f"{self.prefix}:stats:{namespace}", field, n)
+        try:
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Cache stats flush failed, will retry: %s", e)
+            self._pending.restore(counts, {})
+
+    @_fail_open
+    def get(self, namespace, key, default=None):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(self._version_key(namespace))
+        pipe.get(self._key(namespace, key))
+        version, raw = pipe.execute()
+        if raw is not None:
+            stored_version, value = pickle.loads(raw)
+            if stored_version == int(version or 0):
+                self._bump(namespace, "hits")
+                return value
+        self._bump(namespace, "misses")
+        return default
+
+    @_fail_open
+    def set(self, namespace, key, value, ttl=None):
+        version = int(self.client.get(self._version_key(namespace)) or 0)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self._key(namespace, key), pickle.dumps((version, value)),
+                 px=max(1, int((ttl or self.default_ttl) * 1000)))
+        pipe.sadd(f"{self.prefix}:namespaces", namespace)
+        pipe.execute()
+        self._bump(namespace, "sets")
+
+    @_fail_open
+    def delete(self, namespace, key):
+        if self.client.delete(self._key(namespace, key)):
+            self._bump(namespace, "deletes")
+
+    @_fail_open
+    def invalidate(self, namespace):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incr(self._version_key(namespace))
+        pipe.sadd(f"{self.prefix}:namespaces", namespace)
+        pipe.execute()
+        self._bump(namespace, "invalidations")
+
+    def stats(self, namespace=None):
+        # Counters buffered by other workers show up after their next flush
+        self.flush()
+
+        def read(ns):
+            counters = dict.fromkeys(STAT_FIELDS, 0)
+            for field, value in self.client.hgetall(f"{self.prefix}:stats:{ns}").items():
+                field = field.decode() if isinstance(field, bytes) else field
+                counters[field] = int(value)
+            return counters
+
+        if namespace is not None:
+            return read(namespace)
+        namespaces = self.client.smembers(f"{self.prefix}:namespaces")
+        return {
+            (ns.decode() if isinstance(ns, bytes) else ns): read(ns.decode() if isinstance(ns, bytes) else ns)
+            for ns in namespaces
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def create_cache(backend=CACHE_BACKEND, url=CACHE_URL):
+    """
+    Build a cache backend by name: "memory", "sqlite" or "redis".
+    For sqlite, url is the database file path; for redis, the server URL.
+    """
+    if backend == "memory":
+        return MemoryCache()
+    elif backend == "sqlite":
+        return SQLiteCache(path=url)
+    elif backend == "redis":
+        return RedisCache(url=url)
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+def get_cache():
+    """Return the process-wide cache configured by CACHE_BACKEND / CACHE_URL."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = create_cache()
+                logger.info("Cache backend initialized: %s", type(_cache).__name__)
+    return _cache
+
+def set_cache(cache):
+    """Replace the process-wide cache (e.g. with a backend bound to a local stand-in)."""
+    global _cache
+    _cache = cache
@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+from cache import MemoryCache, SQLiteCache, RedisCache, redis
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+
+class FakeRedis:
+    """
+    只實作 RedisCache 用到的 redis-py 指令的記憶體替身，並記錄往返次數
+    （pipeline 的 execute 算一次），用來在沒有 Redis 伺服器時檢查快取行為。
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.round_trips = 0
+        # Set to simulate an unreachable server
+        self.down = False
+
+    def _alive(self, key):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _call(self, name, *args, **kwargs):
+        self.round_trips += 1
+        self._check_up()
+        return getattr(self, "_" + name)(*args, **kwargs)
+
+    def _check_up(self):
+        if self.down:
+            raise redis.ConnectionError("fake server is down")
+
+    def _get(self, key):
+        return self.data[key] if self._alive(key) else None
+
+    def _set(self, key, value, ex=None, px=None):
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+        ttl = ex if ex else px / 1000 if px else None
+        self.expires[key] = time.time() + ttl if ttl else None
+        return True
+
+    def _delete(self, key):
+        return 1 if self._alive(key) and self.data.pop(key) is not None else 0
+
+    def _incr(self, key):
+        value = int(self._get(key) or 0) + 1
+        self.data[key] = str(value).encode()
+        return value
+
+    def _sadd(self, key, member):
+        self.data.setdefault(key, set()).add(member.encode())
+        return 1
+
+    def _smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def _hincrby(self, key, field, amount=1):
+        hash_ = self.data.setdefault(key, {})
+        hash_[field.encode()] = int(hash_.get(field.encode(), 0)) + amount
+        return hash_[field.encode()]
+
+    def _hgetall(self, key):
+        return {field: str(value).encode() for field, value in self.data.get(key, {}).items()}
+
+    def __getattr__(self, name):
+        if hasattr(type(self), "_" + name):
+            return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        self.client.round_trips += 1
+        self.client._check_up()
+        return [getattr(self.client, "_" + name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+def check_backend(cache):
+    """對單一快取後端執行同一組情境，回傳失敗訊息清單"""
+    failures = []
+
+    def expect(label, actual, expected):
+        if actual != expected:
+            failures.append(f"{label}: expected {expected!r}, got {actual!r}")
+
+    expect("miss", cache.get("users", "U1"), None)
+    cache.set("users", "U1", 42)
+    expect("hit", cache.get("users", "U1"), 42)
+    cache.set("responses", "k", {"reply": "您好"}, ttl=60)
+    expect("hit in other namespace", cache.get("responses", "k"), {"reply": "您好"})
+
+    cache.set("summaries", "short", "x", ttl=0.05)
+    time.sleep(0.1)
+    expect("expired", cache.get("summaries", "short", "gone"), "gone")
+
+    cache.invalidate("users")
+    expect("invalidated", cache.get("users", "U1"), None)
+    expect("other namespace survives invalidate", cache.get("responses", "k"), {"reply": "您好"})
+    cache.set("users", "U1", 43)
+    expect("set after invalidate", cache.get("users", "U1"), 43)
+    cache.delete("users", "U1")
+    expect("deleted", cache.get("users", "U1"), None)
+    expect("get_or_set", cache.get_or_set("users", "U2", lambda: 7), 7)
+    expect("get_or_set cached", cache.get_or_set("users", "U2", lambda: 8), 7)
+
+    expect("users stats", cache.stats("users"),
+           {"hits": 3, "misses": 4, "sets": 3, "deletes": 1, "invalidations": 1})
+    expect("responses stats", cache.stats()["responses"],
+           {"hits": 2, "misses": 0, "sets": 1, "deletes": 0, "invalidations": 0})
+    return failures
+
+def check_outage(cache, break_backend):
+    """後端無法使用時應視為未命中：get 回傳預設值，寫入不拋出例外"""
+    failures = []
+    cache.set("users", "U8", 1)
+    break_backend()
+    try:
+        if cache.get("users", "U8", "fallback") != "fallback":
+            failures.append("get during outage did not return the default")
+        cache.set("users", "U8", 2)
+        cache.delete("users", "U8")
+        cache.invalidate("users")
+        if cache.get_or_set("users", "U8", lambda: 3) != 3:
+            failures.append("get_or_set during outage did not return the computed value")
+    except Exception as e:
+        failures.append(f"outage raised {type(e).__name__}: {e}")
+    return failures
+
+def check_sqlite_reads(cache):
+    """命中只讀取，不應寫入資料庫；計數與存取時間在 flush 時一次寫入"""
+    cache.set("users", "U9", 1)
+    conn = cache._conn()
+    before = conn.total_changes
+    for _ in range(10):
+        cache.get("users", "U9")
+    if conn.total_changes != before:
+        return [f"10 hits wrote {conn.total_changes - before} rows, expected 0"]
+    return []
+
+def check_redis_round_trips(client, cache):
+    """get() 與命中計數只應花一次往返；計數在 flush 時以一個 pipeline 送出"""
+    failures = []
+    cache.set("users", "U9", 1)
+    before = client.round_trips
+    for _ in range(10):
+        cache.get("users", "U9")
+    if client.round_trips - before != 10:
+        failures.append(f"10 gets took {client.round_trips - before} round trips, expected 10")
+    before = client.round_trips
+    cache.flush()
+    if client.round_trips - before != 1:
+        failures.append(f"stats flush took {client.round_trips - before} round trips, expected 1")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以相同情境檢查各快取後端的行為與統計")
+    parser.add_argument("--redis-url", help="另外對真正的 Redis 伺服器執行檢查（會寫入 cache-check 前綴的鍵）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="cache-check-")
+    fake = FakeRedis()
+    backends = {
+        "memory": MemoryCache(),
+        "sqlite": SQLiteCache(path=os.path.join(workdir, "cache.db"), flush_interval=3600),
+        "redis (fake client)": RedisCache(client=fake, prefix="cache-check", flush_interval=3600),
+    }
+    if args.redis_url:
+        if redis is None:
+            parser.error("redis package not installed. Please install it with 'pip install redis'.")
+        client = redis.Redis.from_url(args.redis_url)
+        for key in client.scan_iter("cache-check:*"):
+            client.delete(key)
+        backends["redis"] = RedisCache(client=client, prefix="cache-check")
+
+    failed = False
+    for name, cache in backends.items():
+        failures = check_backend(cache)
+        if name == "sqlite":
+            failures += check_sqlite_reads(cache)
+            failures += check_outage(cache, lambda: cache._conn().close())
+        if name == "redis (fake client)":
+            failures += check_redis_round_trips(fake, cache)
+            if redis is not None:
+                failures += check_outage(cache, lambda: setattr(fake, "down", True))
+        print(f"{name}: {'OK' if not failures else 'FAILED'}")
+        for failure in failures:
+            print(f"  {failure}")
+        failed = failed or bool(failures)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    # 中斷情境會刻意觸發快取警告
+    logging.basicConfig(level=logging.ERROR)
+    main()
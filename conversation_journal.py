@@ -0,0 +1,379 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import atexit
+import logging
+import datetime
+import threading
+from sqlalchemy import select, insert, update, or_
+from sqlalchemy.exc import OperationalError, InterfaceError
+from app import app, db, basedir
+from models import Conversation, User
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Journal configuration
+JOURNAL_ENABLED = os.environ.get("JOURNAL_ENABLED", "1") == "1"
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR", os.path.join(basedir, "journal"))
+# A batch is committed when it reaches JOURNAL_BATCH_SIZE rows or is this old, whichever comes first
+JOURNAL_FLUSH_INTERVAL_MS = int(os.environ.get("JOURNAL_FLUSH_INTERVAL_MS", "200"))
+JOURNAL_BATCH_SIZE = int(os.environ.get("JOURNAL_BATCH_SIZE", "500"))
+# Appends wait for the flusher once this many rows are pending (e.g. while the database is down)
+JOURNAL_MAX_PENDING = int(os.environ.get("JOURNAL_MAX_PENDING", "10000"))
+# fsync every append (survives power loss) instead of only flushing to the OS (survives process crashes)
+JOURNAL_FSYNC = os.environ.get("JOURNAL_FSYNC", "0") == "1"
+# A batch that fails this many flushes in a row (for a reason other than the database being
+# unreachable) is retried one row at a time; rows that still fail go to the dead-letter directory
+JOURNAL_MAX_RETRIES = int(os.environ.get("JOURNAL_MAX_RETRIES", "3"))
+JOURNAL_DEAD_LETTER_DIR = os.environ.get("JOURNAL_DEAD_LETTER_DIR", os.path.join(JOURNAL_DIR, "dead-letter"))
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def _decode(row):
+    if row.get("timestamp"):
+        row["timestamp"] = datetime.datetime.fromisoformat(row["timestamp"])
+    return row
+
+def _is_transient(error):
+    # Database unreachable or locked: every row would fail the same way, so keep them pending
+    return isinstance(error, (OperationalError, InterfaceError))
+
+
+class _Segment:
+    """
+    One append-only journal file. The owning process holds an exclusive
+    flock on it until its rows are committed, so recovery in another
+    process only picks up segments whose owner has exited. The file is
+    created under a temporary name and renamed once locked; recovery only
+    reads .jsonl files, so it never sees a segment before its lock is held.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + ".tmp", "a", encoding="utf-8")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        os.rename(path + ".tmp", path)
+
+    def write(self, line, fsync=False):
+        self.file.write(line)
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def discard(self):
+        # Unlink before closing so the file is gone by the time the lock is released
+        os.remove(self.path)
+        self.file.close()
+
+
+class ConversationJournal:
+    """
+    Write-behind store for conversations.
+
+    append() writes the row to a local journal file and returns immediately;
+    a background thread inserts pending rows in multi-row batches with one
+    commit per batch and updates the rollups for the whole batch. Every row
+    carries a journal_id, so replaying a segment that was partly committed
+    before a crash does not insert duplicates.
+
+    The batch also advances users.last_interaction, so the request path
+    needs no write of its own for known users. A batch that keeps failing
+    is retried row by row after max_retries flushes and the rows that
+    still fail are moved to the dead-letter directory, so one bad row
+    cannot hold back the rows behind it.
+    """
+
+    def __init__(self, directory=JOURNAL_DIR, enabled=JOURNAL_ENABLED,
+                 flush_interval_ms=JOURNAL_FLUSH_INTERVAL_MS, batch_size=JOURNAL_BATCH_SIZE,
+                 max_pending=JOURNAL_MAX_PENDING, fsync=JOURNAL_FSYNC,
+                 max_retries=JOURNAL_MAX_RETRIES, dead_letter_dir=JOURNAL_DEAD_LETTER_DIR):
+        self.directory = directory
+        self.enabled = enabled
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self.max_retries = max_retries
+        self.dead_letter_dir = dead_letter_dir
+
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._thread = None
+        self._segment = None
+        # Closed segments whose rows are still pending; together with _segment they hold exactly _pending
+        self._segments = []
+        # (monotonic time appended, row)
+        self._pending = []
+        # Flushes that failed in a row
+        self._failures = 0
+        self._stats = {
+            "flushed": 0, "batches": 0, "errors": 0, "replayed": 0, "dead_lettered": 0,
+            "last_batch_size": 0, "last_commit_ms": 0, "last_lag_ms": 0, "max_lag_ms": 0,
+        }
+
+    def append(self, **fields):
+        """Journal one conversation and return its journal_id."""
+        row = dict(fields)
+        row["journal_id"] = uuid.uuid4().hex
+        row.setdefault("timestamp", datetime.datetime.utcnow())
+
+        if not self.enabled:
+            self._write_rows([row])
+            return row["journal_id"]
+
+        line = json.dumps(row, ensure_ascii=False, default=_encode) + "\n"
+        with self._lock:
+            self._ensure_started()
+            while len(self._pending) >= self.max_pending:
+                self._wakeup.set()
+                self._flushed.wait(self.flush_interval)
+            if self._segment is None:
+                self._segment = _Segment(os.path.join(self.directory, f"{os.getpid()}-{time.time_ns()}.jsonl"))
+            self._segment.write(line, fsync=self.fsync)
+            self._pending.append((time.monotonic(), row))
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+        return row["journal_id"]
+
+    def _ensure_started(self):
+        # Called with _lock held; also restarts the flusher in a forked worker
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = []
+        self._segments = []
+        self._segment = None
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="conversation-journal", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Journal flush failed: %s", e)
+
+    def flush(self):
+        """Commit every pending row; returns the number of rows inserted."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, []
+                segments = self._segments + ([self._segment] if self._segment else [])
+                self._segments, self._segment = [], None
+
+            started = time.monotonic()
+            rows = [row for _, row in batch]
+            try:
+                inserted = 0
+                for start in range(0, len(rows), self.batch_size):
+                    inserted += self._write_rows(rows[start:start + self.batch_size])
+            except Exception as e:
+                self._failures += 1
+                try:
+                    if _is_transient(e) or self._failures < self.max_retries:
+                        raise
+                    logger.error("Journal flush of %d rows failed %d times, retrying row by row: %s",
+                                 len(rows), self._failures, e)
+                    # Chunks committed before the failure are skipped by journal_id
+                    inserted = self._write_rows_one_by_one(rows)
+                except Exception as e:
+                    logger.error("Journal flush of %d rows failed, will retry: %s", len(rows), e)
+                    with self._lock:
+                        self._pending = batch + self._pending
+                        self._segments = segments + self._segments
+                        self._stats["errors"] += 1
+                    return 0
+
+            self._failures = 0
+            for segment in segments:
+                segment.discard()
+            finished = time.monotonic()
+            with self._lock:
+                lag_ms = round((finished - batch[0][0]) * 1000)
+                self._stats["flushed"] += inserted
+                self._stats["batches"] += 1
+                self._stats["last_batch_size"] = len(batch)
+                self._stats["last_commit_ms"] = round((finished - started) * 1000)
+                self._stats["last_lag_ms"] = lag_ms
+                self._stats["max_lag_ms"] = max(self._stats["max_lag_ms"], lag_ms)
+                self._flushed.notify_all()
+            return inserted
+
+    def _write_rows(self, rows):
+        """
+        Insert rows not yet in the database with one multi-row INSERT and update
+        the rollups and each user's last_interaction in the same transaction, so
+        a replayed row is never counted twice.
+        """
+        from analytics import add_conversations
+
+        with app.app_context():
+            ids = [row["journal_id"] for row in rows]
+            existing = set(db.session.scalars(
+                select(Conversation.journal_id).where(Conversation.journal_id.in_(ids))
+            ))
+            rows = [row for row in rows if row["journal_id"] not in existing]
+            if not rows:
+                return 0
+            try:
+                db.session.execute(insert(Conversation), rows)
+                add_conversations([Conversation(**row) for row in rows])
+                last_interaction = {}
+                for row in rows:
+                    user_id = row["user_id"]
+                    last_interaction[user_id] = max(last_interaction.get(user_id, row["timestamp"]), row["timestamp"])
+                for user_id, timestamp in last_interaction.items():
+                    # Never move it backwards when an older segment is replayed
+                    db.session.execute(
+                        update(User)
+                        .where(User.id == user_id)
+                        .where(or_(User.last_interaction.is_(None), User.last_interaction < timestamp))
+                        .values(last_interaction=timestamp)
+                    )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            return len(rows)
+
+    def _write_rows_one_by_one(self, rows):
+        """
+        Insert rows one at a time and move the ones that fail to the dead-letter
+        directory. A transient error stops the pass and is raised, so the rows
+        stay pending instead of being dead-lettered during an outage.
+        """
+        inserted = 0
+        dead = []
+        for row in rows:
+            try:
+                inserted += self._write_rows([row])
+            except Exception as e:
+                if _is_transient(e):
+                    raise
+                dead.append((row, e))
+        if dead:
+            self._dead_letter(dead)
+        return inserted
+
+    def _dead_letter(self, failed):
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+        path = os.path.join(self.dead_letter_dir, f"{os.getpid()}-{time.time_ns()}.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for row, error in failed:
+                f.write(json.dumps(dict(row, error=repr(error)), ensure_ascii=False, default=_encode) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        for row, error in failed:
+            logger.error("Moved journaled conversation %s to %s: %s", row["journal_id"], path, error)
+        with self._lock:
+            self._stats["dead_lettered"] += len(failed)
+
+    def recover(self):
+        """
+        Replay journal segments left behind by processes that exited before
+        their rows were committed. Segments still locked by a live process are
+        skipped. Returns the number of rows inserted.
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+
+        replayed = 0
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".jsonl.tmp"):
+                self._remove_abandoned(os.path.join(self.directory, name))
+                continue
+            if not name.endswith(".jsonl"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                f = open(path, encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                # Already committed and removed by its owner between listdir() and flock()
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    continue
+
+                rows = []
+                for line_no, line in enumerate(f, 1):
+                    try:
+                        rows.append(_decode(json.loads(line)))
+                    except ValueError:
+                        # A crash mid-append leaves a truncated last line
+                        logger.warning("Skipping unreadable journal line %s:%d", name, line_no)
+                for start in range(0, len(rows), self.batch_size):
+                    chunk = rows[start:start + self.batch_size]
+                    try:
+                        replayed += self._write_rows(chunk)
+                    except Exception as e:
+                        if _is_transient(e):
+                            raise
+                        logger.error("Replay of %s failed, retrying row by row: %s", name, e)
+                        replayed += self._write_rows_one_by_one(chunk)
+                os.remove(path)
+
+        if replayed:
+            logger.info("Recovered %d journaled conversations", replayed)
+        with self._lock:
+            self._stats["replayed"] += replayed
+        return replayed
+
+    def _remove_abandoned(self, path):
+        # A process that died between creating and renaming a segment; nothing was written to it yet
+        try:
+            f = open(path, encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            if os.fstat(f.fileno()).st_nlink:
+                os.remove(path)
+
+    def stats(self):
+        """Queue depth and flush lag; oldest_pending_ms is the current lag."""
+        now = time.monotonic()
+        with self._lock:
+            return dict(
+                self._stats,
+                enabled=self.enabled,
+                pending=len(self._pending),
+                oldest_pending_ms=round((now - self._pending[0][0]) * 1000) if self._pending else 0,
+                flush_interval_ms=round(self.flush_interval * 1000),
+                batch_size=self.batch_size,
+            )
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+def get_journal():
+    """Return the process-wide conversation journal."""
+    global _journal
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                _journal = ConversationJournal()
+    return _journal
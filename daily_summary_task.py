@@ -1,32 +1,51 @@
 import os
+import io
+import json
 import datetime
+import argparse
 import schedule
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from app import app, db
 from models import Conversation, DailySummary
-from openai_service import generate_response
+from openai_service import (generate_response, openai, classify_question, decide_need_followup,
+                            build_system_prompt, build_chat_request, format_response)
+from cache import get_cache
 
 # 設置日誌
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 修改摘要提示後請遞增，舊版本產生的摘要在回填時會被視為過期
+SUMMARY_PROMPT_VERSION = 1
+# 回填時同時生成摘要的日期數
+BACKFILL_CONCURRENCY = int(os.environ.get("BACKFILL_CONCURRENCY", "4"))
+
 def fetch_today_messages():
     """撈取今天的聊天紀錄"""
+    return fetch_messages(datetime.datetime.now().date())
+
+def fetch_messages(summary_date):
+    """撈取指定日期的聊天紀錄"""
     with app.app_context():
-        today = datetime.datetime.now().date()
-        today_start = datetime.datetime.combine(today, datetime.time.min)  # 今天的開始時間
-        today_end = datetime.datetime.combine(today, datetime.time.max)    # 今天的結束時間
+        day_start = datetime.datetime.combine(summary_date, datetime.time.min)  # 當天的開始時間
+        day_end = datetime.datetime.combine(summary_date, datetime.time.max)    # 當天的結束時間
         
-        # 取得今天的所有對話
+        # 取得當天的所有對話
         conversations = Conversation.query.filter(
-            Conversation.timestamp >= today_start,
-            Conversation.timestamp <= today_end
-        ).all()
+            Conversation.timestamp >= day_start,
+            Conversation.timestamp <= day_end
+        ).order_by(Conversation.timestamp).all()
         
         messages = []
         for conv in conversations:
             messages.append(f"用戶: {conv.user_message}")
+            # 合併回覆的前幾則訊息沒有自己的回覆，與下一則一起由機器人回答
+            if conv.merged or not conv.bot_response:
+                continue
             messages.append(f"機器人: {conv.bot_response}")
             messages.append("---")
         
@@ -37,42 +56,58 @@ def generate_summary(messages):
     if not messages:
         return "今日無對話紀錄"
     
-    combined_text = "\n".join(messages)
-    
     # 使用現有的 generate_response 函數來生成摘要
     try:
         # 特殊提示用於生成摘要
-        summary_prompt = f"你是一個專業的摘要助手，請根據以下聊天紀錄，生成一份簡潔的摘要，總結主要話題和內容。摘要應控制在 100-200 字內。\n\n以下是今天的聊天紀錄，請摘要:\n\n{combined_text}"
+        summary_prompt = build_summary_prompt(messages)
         
         # 使用現有的 generate_response 函數
         summary = generate_response(summary_prompt)
         return summary
     except Exception as e:
-        logger.error(f"生成摘要時發生錯誤: {e}")
+        logger.error("生成摘要時發生錯誤: %s", e)
         return f"生成摘要時發生錯誤: {str(e)}"
 
-def save_summary(summary):
-    """將摘要存入資料庫"""
+def build_summary_prompt(messages):
+    """摘要提示（同步生成與 Batch API 共用）"""
+    combined_text = "\n".join(messages)
+    return f"你是一個專業的摘要助手，請根據以下聊天紀錄，生成一份簡潔的摘要，總結主要話題和內容。摘要應控制在 100-200 字內。\n\n以下是今天的聊天紀錄，請摘要:\n\n{combined_text}"
+
+def save_summary(summary, summary_date=None):
+    """將摘要存入資料庫（以 summary_date 為鍵 upsert）"""
+    summary_date = summary_date or datetime.datetime.now().date()
     with app.app_context():
-        today = datetime.datetime.now().date()
-        
-        # 檢查今天是否已有摘要
-        existing = DailySummary.query.filter_by(summary_date=today).first()
-        
-        if existing:
-            # 更新現有摘要
-            existing.summary_content = summary
-            logger.info(f"更新了 {today} 的摘要")
-        else:
-            # 創建新摘要
-            new_summary = DailySummary(
-                summary_date=today,
-                summary_content=summary
-            )
-            db.session.add(new_summary)
-            logger.info(f"新增了 {today} 的摘要")
-        
-        db.session.commit()
+        for attempt in range(2):
+            # 檢查當天是否已有摘要
+            existing = DailySummary.query.filter_by(summary_date=summary_date).first()
+            
+            if existing:
+                # 更新現有摘要
+                existing.summary_content = summary
+                existing.prompt_version = SUMMARY_PROMPT_VERSION
+                existing.updated_at = datetime.datetime.utcnow()
+                logger.info("更新了 %s 的摘要", summary_date)
+            else:
+                # 創建新摘要
+                new_summary = DailySummary(
+                    summary_date=summary_date,
+                    summary_content=summary,
+                    prompt_version=SUMMARY_PROMPT_VERSION
+                )
+                db.session.add(new_summary)
+                logger.info("新增了 %s 的摘要", summary_date)
+            
+            try:
+                db.session.commit()
+                break
+            except IntegrityError:
+                # 另一個行程剛好同時新增了同一天的摘要，改為更新；再次衝突則不是競爭造成的
+                db.session.rollback()
+                if attempt == 1:
+                    raise
+    
+    # 摘要已變更，讓各 worker 的摘要快取失效
+    get_cache().invalidate("summaries")
 
 def daily_task():
     """每日摘要任務"""
@@ -80,10 +115,10 @@ def daily_task():
     messages = fetch_today_messages()
     
     if messages:
-        logger.info(f"找到 {len(messages)} 筆聊天紀錄")
+        logger.info("找到 %d 筆聊天紀錄", len(messages))
         summary = generate_summary(messages)
         save_summary(summary)
-        logger.info(f"已成功生成 {datetime.datetime.now().date()} 的摘要")
+        logger.info("已成功生成 %s 的摘要", datetime.datetime.now().date())
     else:
         logger.info("今天沒有聊天紀錄，不生成摘要")
 
@@ -93,6 +128,161 @@ def manual_run_task():
     daily_task()
     return "每日摘要任務已執行完成"
 
+def find_dates_to_backfill(start_date, end_date, force=False):
+    """
+    找出區間內有對話、但摘要不存在或已過期的日期。
+    過期：摘要的提示版本較舊，或摘要更新後當天又有新的對話。force 則回傳所有有對話的日期。
+    """
+    with app.app_context():
+        day = func.date(Conversation.timestamp)
+        rows = db.session.query(day, func.max(Conversation.timestamp)).filter(
+            Conversation.timestamp >= datetime.datetime.combine(start_date, datetime.time.min),
+            Conversation.timestamp <= datetime.datetime.combine(end_date, datetime.time.max)
+        ).group_by(day).all()
+        
+        summaries = {
+            s.summary_date: s for s in DailySummary.query.filter(
+                DailySummary.summary_date >= start_date,
+                DailySummary.summary_date <= end_date
+            )
+        }
+        
+        dates = []
+        for value, last_message_at in rows:
+            # SQLite 的 date() 回傳字串，PostgreSQL 回傳 date
+            summary_date = value if isinstance(value, datetime.date) else datetime.date.fromisoformat(value)
+            summary = summaries.get(summary_date)
+            if force or summary is None:
+                dates.append(summary_date)
+                continue
+            summarized_at = summary.updated_at or summary.created_at
+            if (summary.prompt_version or 1) < SUMMARY_PROMPT_VERSION or (summarized_at and summarized_at < last_message_at):
+                dates.append(summary_date)
+        return sorted(dates)
+
+def summary_request(messages):
+    """與 generate_response 的專業問題流程相同的請求內容（同步回填與 Batch API 共用）"""
+    prompt = build_summary_prompt(messages)
+    category = classify_question(prompt)
+    system_prompt = build_system_prompt(category, prompt, "", decide_need_followup(prompt))
+    return build_chat_request(system_prompt, prompt)
+
+def regenerate_summary(summary_date):
+    """
+    重新生成並儲存指定日期的摘要。直接呼叫 OpenAI 而不經過 generate_response，
+    失敗時拋出例外、不寫入，避免把錯誤訊息存成摘要。
+    """
+    messages = fetch_messages(summary_date)
+    if not messages:
+        return False
+    response = openai.chat.completions.create(**summary_request(messages))
+    raw_reply = (response.choices[0].message.content or "").strip()
+    if not raw_reply:
+        raise ValueError("模型回傳空白摘要")
+    save_summary(format_response(raw_reply), summary_date)
+    return True
+
+def backfill_summaries(start_date, end_date, force=False, concurrency=BACKFILL_CONCURRENCY):
+    """
+    回填區間內缺少或過期的每日摘要，最多同時處理 concurrency 天。
+    每天完成即寫入，因此中斷後重新執行只會處理剩下的日期。
+    """
+    dates = find_dates_to_backfill(start_date, end_date, force)
+    logger.info("需要回填 %d 天的摘要", len(dates))
+    
+    done, failed = [], []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(regenerate_summary, d): d for d in dates}
+        for future in as_completed(futures):
+            summary_date = futures[future]
+            try:
+                future.result()
+                done.append(summary_date)
+            except Exception as e:
+                logger.error("回填 %s 的摘要失敗: %s", summary_date, e)
+                failed.append(summary_date)
+    
+    get_cache().invalidate("summaries")
+    return {"regenerated": [d.isoformat() for d in sorted(done)], "failed": [d.isoformat() for d in sorted(failed)]}
+
+def _batch_request(summary_date, messages):
+    return {
+        "custom_id": f"summary-{summary_date.isoformat()}",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": summary_request(messages)
+    }
+
+def submit_backfill_batch(start_date, end_date, force=False):
+    """
+    以 OpenAI Batch API 提交回填（費用較低，24 小時內完成）。
+    回傳 batch id，之後用 collect_backfill_batch 取回結果。
+    """
+    dates = find_dates_to_backfill(start_date, end_date, force)
+    lines = []
+    for summary_date in dates:
+        messages = fetch_messages(summary_date)
+        if messages:
+            lines.append(json.dumps(_batch_request(summary_date, messages), ensure_ascii=False))
+    if not lines:
+        logger.info("沒有需要回填的摘要")
+        return None
+    
+    batch_file = openai.files.create(
+        file=("summary_backfill.jsonl", io.BytesIO("\n".join(lines).encode("utf-8"))),
+        purpose="batch"
+    )
+    batch = openai.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={"task": "daily_summary_backfill"}
+    )
+    logger.info("已提交 %d 天的摘要回填批次: %s", len(lines), batch.id)
+    return batch.id
+
+def collect_backfill_batch(batch_id):
+    """
+    取回 Batch API 結果並寫入摘要。尚未結束時只回傳狀態；批次逾時（expired）或被取消
+    （cancelled）時仍寫入已完成的部分，未完成的日期列在 failed，可重新提交回填。
+    寫入以 summary_date upsert，重複執行不會產生重複資料。
+    """
+    batch = openai.batches.retrieve(batch_id)
+    if batch.status not in ("completed", "expired", "cancelled"):
+        logger.info("批次 %s 狀態: %s", batch_id, batch.status)
+        return {"status": batch.status, "saved": [], "failed": []}
+    if batch.status != "completed":
+        logger.warning("批次 %s 狀態為 %s，只寫入已完成的部分", batch_id, batch.status)
+    
+    saved, failed = [], []
+    lines = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            lines += openai.files.content(file_id).text.splitlines()
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        summary_date = datetime.date.fromisoformat(item["custom_id"].removeprefix("summary-"))
+        response = item.get("response") or {}
+        body = response.get("body") or {}
+        raw_reply = ""
+        if not item.get("error") and response.get("status_code") == 200:
+            raw_reply = (body["choices"][0]["message"]["content"] or "").strip()
+        if not raw_reply:
+            failed.append(summary_date.isoformat())
+            continue
+        try:
+            save_summary(format_response(raw_reply), summary_date)
+        except Exception as e:
+            logger.error("寫入 %s 的摘要失敗: %s", summary_date, e)
+            failed.append(summary_date.isoformat())
+            continue
+        saved.append(summary_date.isoformat())
+    
+    get_cache().invalidate("summaries")
+    return {"status": batch.status, "saved": sorted(saved), "failed": sorted(failed)}
+
 # 設定每天台灣時間晚上 8 點執行 (UTC+8)
 def schedule_tasks():
     # 在 UTC 時間下的 12:00 執行 (對應台灣時間 20:00)
@@ -104,5 +294,32 @@ def schedule_tasks():
         schedule.run_pending()
         time.sleep(60)
 
+def main():
+    parser = argparse.ArgumentParser(description="每日摘要排程與歷史摘要回填")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    parse_date = lambda v: datetime.datetime.strptime(v, "%Y-%m-%d").date()
+    backfill_parser = subparsers.add_parser("backfill", help="回填缺少或過期的每日摘要")
+    backfill_parser.add_argument("--start", type=parse_date, required=True)
+    backfill_parser.add_argument("--end", type=parse_date, default=datetime.datetime.now().date())
+    backfill_parser.add_argument("--force", action="store_true", help="重新生成區間內所有日期")
+    backfill_parser.add_argument("--concurrency", type=int, default=BACKFILL_CONCURRENCY)
+    backfill_parser.add_argument("--batch", action="store_true", help="改用 OpenAI Batch API 提交")
+    
+    collect_parser = subparsers.add_parser("collect-batch", help="取回 Batch API 回填結果")
+    collect_parser.add_argument("batch_id")
+    
+    args = parser.parse_args()
+    
+    if args.command == "backfill":
+        if args.batch:
+            print(submit_backfill_batch(args.start, args.end, args.force))
+        else:
+            print(json.dumps(backfill_summaries(args.start, args.end, args.force, args.concurrency), ensure_ascii=False))
+    elif args.command == "collect-batch":
+        print(json.dumps(collect_backfill_batch(args.batch_id), ensure_ascii=False))
+    else:
+        schedule_tasks()
+
 if __name__ == "__main__":
-    schedule_tasks()
\ No newline at end of file
+    main()
\ No newline at end of file
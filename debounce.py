@@ -0,0 +1,111 @@
+import os
+import time
+import asyncio
+import datetime
+import threading
+from collections import namedtuple
+
+# Messages from one user arriving less than DEBOUNCE_SECONDS apart are answered together; 0 disables
+DEBOUNCE_SECONDS = float(os.environ.get("DEBOUNCE_SECONDS", "1.5"))
+# Window for the Flask webhook, where the burst leader sleeps in its worker. Off by default: with
+# sync gunicorn workers a sleeping leader blocks the worker, so only enable it with --threads or gevent
+DEBOUNCE_SYNC_SECONDS = float(os.environ.get("DEBOUNCE_SYNC_SECONDS", "0"))
+# A burst is answered at the latest this long after its first message, or once it has this many messages
+DEBOUNCE_MAX_WAIT_SECONDS = float(os.environ.get("DEBOUNCE_MAX_WAIT_SECONDS", "5"))
+DEBOUNCE_MAX_MESSAGES = int(os.environ.get("DEBOUNCE_MAX_MESSAGES", "5"))
+
+PendingMessage = namedtuple("PendingMessage", ["text", "reply_token", "timestamp"])
+
+
+class _Burst:
+    def __init__(self, first_at):
+        self.first_at = first_at
+        self.last_at = first_at
+        self.messages = []
+
+
+class MessageDebouncer:
+    """
+    Groups quick successive messages from the same user into one burst.
+
+    The handler of the first message in a burst becomes its leader: it waits
+    until the user has been quiet for `window` seconds and then answers the
+    whole burst. Handlers of later messages only add their message and
+    return. State is per process, so with several workers a burst is only
+    merged when its messages reach the same worker.
+    """
+
+    def __init__(self, window=DEBOUNCE_SECONDS, max_wait=DEBOUNCE_MAX_WAIT_SECONDS,
+                 max_messages=DEBOUNCE_MAX_MESSAGES):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._bursts = {}
+
+    def submit(self, user_key, text, reply_token):
+        """Add a message; returns the burst if the caller should answer it, otherwise None."""
+        now = time.monotonic()
+        message = PendingMessage(text, reply_token, datetime.datetime.utcnow())
+        with self._lock:
+            burst = self._bursts.get(user_key)
+            if burst is not None:
+                burst.messages.append(message)
+                burst.last_at = now
+                return None
+            burst = _Burst(now)
+            burst.messages.append(message)
+            if self.window > 0:
+                self._bursts[user_key] = burst
+            return burst
+
+    def _remaining(self, user_key, burst):
+        # Seconds left to wait, or 0 after closing the burst so later messages start a new one
+        with self._lock:
+            if self._bursts.get(user_key) is not burst:
+                return 0
+            deadline = min(burst.last_at + self.window, burst.first_at + self.max_wait)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or len(burst.messages) >= self.max_messages:
+                del self._bursts[user_key]
+                return 0
+            return remaining
+
+    def wait(self, user_key, burst):
+        """Block until the burst is complete and return its messages in arrival order."""
+        while True:
+            remaining = self._remaining(user_key, burst)
+            if not remaining:
+                return list(burst.messages)
+            time.sleep(remaining)
+
+    async def wait_async(self, user_key, burst):
+        """Coroutine version of wait()."""
+        while True:
+            remaining = self._remaining(user_key, burst)
+            if not remaining:
+                return list(burst.messages)
+            await asyncio.sleep(remaining)
+
+
+def merge_messages(messages):
+    """Text sent to the LLM for a burst: the messages in order, one per line."""
+    return "\n".join(message.text for message in messages)
+
+
+_debouncers = {}
+_debouncer_lock = threading.Lock()
+
+def get_debouncer(blocking=False):
+    """
+    Return the process-wide debouncer: configured by DEBOUNCE_SECONDS for the
+    async server, or by DEBOUNCE_SYNC_SECONDS for callers that block in wait().
+    """
+    debouncer = _debouncers.get(blocking)
+    if debouncer is None:
+        with _debouncer_lock:
+            debouncer = _debouncers.get(blocking)
+            if debouncer is None:
+                window = DEBOUNCE_SYNC_SECONDS if blocking else DEBOUNCE_SECONDS
+                debouncer = _debouncers[blocking] = MessageDebouncer(window)
+    return debouncer
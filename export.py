@@ -0,0 +1,228 @@
+import io
+import csv
+import sys
+import json
+import logging
+import argparse
+import datetime
+from sqlalchemy import select
+from app import app, db
+from models import User, Conversation, DailySummary
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 每次從資料庫取出並輸出的列數
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+}
+# Parquet 需要選用套件 pyarrow（pip install ".[parquet]"）
+if pa is not None:
+    EXPORT_FORMATS["parquet"] = ("application/vnd.apache.parquet", "parquet")
+PARQUET_MISSING = "pyarrow package not installed. Please install it with 'pip install \".[parquet]\"'."
+
+CONVERSATION_COLUMNS = [
+    "id", "timestamp", "user_id", "line_user_id", "display_name",
+    "industry", "role", "user_message", "bot_response", "merged", "intent", "category",
+    "needs_followup", "prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens", "latency_ms",
+]
+SUMMARY_COLUMNS = ["id", "summary_date", "summary_content", "created_at"]
+
+
+def parse_date(value):
+    """將 YYYY-MM-DD 字串轉為 date，空值回傳 None"""
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+def conversation_query(start=None, end=None, user_id=None, industry=None, role=None):
+    """建立對話匯出查詢（Conversation join User），日期區間包含 end 當天"""
+    query = select(
+        Conversation.id,
+        Conversation.timestamp,
+        Conversation.user_id,
+        User.line_user_id,
+        User.display_name,
+        User.industry,
+        User.role,
+        Conversation.user_message,
+        Conversation.bot_response,
+        Conversation.merged,
+        Conversation.intent,
+        Conversation.category,
+        Conversation.needs_followup,
+        Conversation.prompt_tokens,
+        Conversation.completion_tokens,
+        Conversation.total_tokens,
+        Conversation.cached_tokens,
+        Conversation.latency_ms,
+    ).join(User, User.id == Conversation.user_id)
+
+    if start:
+        query = query.where(Conversation.timestamp >= datetime.datetime.combine(start, datetime.time.min))
+    if end:
+        query = query.where(Conversation.timestamp < datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time.min))
+    if user_id:
+        query = query.where(Conversation.user_id == user_id)
+    if industry:
+        query = query.where(User.industry == industry)
+    if role:
+        query = query.where(User.role == role)
+    return query.order_by(Conversation.id)
+
+def summary_query(start=None, end=None):
+    """建立每日摘要匯出查詢"""
+    query = select(
+        DailySummary.id,
+        DailySummary.summary_date,
+        DailySummary.summary_content,
+        DailySummary.created_at,
+    )
+    if start:
+        query = query.where(DailySummary.summary_date >= start)
+    if end:
+        query = query.where(DailySummary.summary_date <= end)
+    return query.order_by(DailySummary.summary_date)
+
+def iter_row_chunks(query, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    以伺服器端游標逐批取出資料列，記憶體用量與總列數無關。
+    """
+    result = db.session.execute(query.execution_options(stream_results=True, yield_per=chunk_size))
+    for partition in result.partitions(chunk_size):
+        yield [tuple(row) for row in partition]
+
+def _serialize(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+def iter_csv(chunks, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows([_serialize(v) for v in row] for row in rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+def iter_jsonl(chunks, columns):
+    for rows in chunks:
+        lines = [
+            json.dumps(dict(zip(columns, map(_serialize, row))), ensure_ascii=False)
+            for row in rows
+        ]
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """只進不退的寫入目標，讓 Parquet 每寫完一個 row group 就能把位元組送出"""
+
+    def __init__(self):
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def arrow_schema(query, columns):
+    """依查詢選取欄位的 SQLAlchemy 型別建立 Parquet schema，不依賴資料內容推斷"""
+    arrow_types = {
+        bool: pa.bool_(),
+        int: pa.int64(),
+        float: pa.float64(),
+        str: pa.string(),
+        datetime.datetime: pa.timestamp("us"),
+        datetime.date: pa.date32(),
+    }
+    fields = []
+    for name, column in zip(columns, query.selected_columns):
+        try:
+            arrow_type = arrow_types.get(column.type.python_type, pa.string())
+        except NotImplementedError:
+            arrow_type = pa.string()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+def iter_parquet(chunks, columns, schema):
+    sink = _ChunkSink()
+    # 每一批都使用同一個 schema；舊資料列的新欄位全為空值時型別也不會改變
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    for rows in chunks:
+        writer.write_table(pa.Table.from_pylist([dict(zip(columns, row)) for row in rows], schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+def stream_export(query, columns, fmt, chunk_size=EXPORT_CHUNK_SIZE):
+    """依格式回傳位元組片段的產生器"""
+    chunks = iter_row_chunks(query, chunk_size)
+    if fmt == "csv":
+        return iter_csv(chunks, columns)
+    elif fmt == "jsonl":
+        return iter_jsonl(chunks, columns)
+    elif fmt == "parquet":
+        if pa is None:
+            raise RuntimeError(PARQUET_MISSING)
+        return iter_parquet(chunks, columns, arrow_schema(query, columns))
+    raise ValueError(f"Unsupported export format: {fmt}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="匯出對話紀錄或每日摘要")
+    parser.add_argument("dataset", choices=["conversations", "summaries"])
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--out", help="輸出檔案路徑，預設寫到 stdout")
+    parser.add_argument("--start", type=parse_date, help="起始日期 YYYY-MM-DD")
+    parser.add_argument("--end", type=parse_date, help="結束日期 YYYY-MM-DD（含當天）")
+    parser.add_argument("--user-id", type=int)
+    parser.add_argument("--industry")
+    parser.add_argument("--role")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.dataset == "conversations":
+            query = conversation_query(args.start, args.end, args.user_id, args.industry, args.role)
+            columns = CONVERSATION_COLUMNS
+        else:
+            query = summary_query(args.start, args.end)
+            columns = SUMMARY_COLUMNS
+
+        out = open(args.out, "wb") if args.out else sys.stdout.buffer
+        try:
+            for data in stream_export(query, columns, args.format, args.chunk_size):
+                out.write(data)
+        finally:
+            if args.out:
+                out.close()
+    logger.info("已匯出 %s（%s）", args.dataset, args.format)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
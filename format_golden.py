@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import time
+import random
+import difflib
+import logging
+import argparse
+import statistics
+
+# 格式化不會呼叫 OpenAI，但 openai_service 載入時需要 API key 才能建立 client
+os.environ.setdefault("OPENAI_API_KEY", "format-golden-stub")
+
+from openai_service import format_response, parse_points, RESPONSE_MIN_CHARS, RESPONSE_MAX_CHARS
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "format_corpus")
+CORPUS_PATH = os.path.join(CORPUS_DIR, "raw.jsonl")
+GOLDEN_PATH = os.path.join(CORPUS_DIR, "golden.jsonl")
+
+
+def load_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def render(item):
+    """以語料 id 作為亂數種子，同一筆語料每次輸出相同"""
+    return format_response(item["raw"], random.Random(item["id"]))
+
+def check(corpus, golden):
+    """比對格式化結果與 golden 檔，回傳不一致的筆數"""
+    expected = {item["id"]: item["output"] for item in golden}
+    failures = 0
+    for item in corpus:
+        output = render(item)
+        if item["id"] not in expected:
+            print(f"{item['id']}: 沒有 golden 輸出")
+            failures += 1
+        elif output != expected[item["id"]]:
+            print(f"{item['id']}: 輸出與 golden 不同")
+            sys.stdout.writelines(difflib.unified_diff(
+                expected[item["id"]].splitlines(keepends=True), output.splitlines(keepends=True),
+                "golden", "current"
+            ))
+            print()
+            failures += 1
+    return failures
+
+def update(corpus, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for item in corpus:
+            f.write(json.dumps({"id": item["id"], "output": render(item)}, ensure_ascii=False) + "\n")
+
+def bench(corpus, rounds):
+    """
+    量測每筆格式化耗時，並統計輸出長度是否落在字數預算內。
+    short_source 為未達下限、但已放入全部要點且未截斷的筆數，即模型輸出本身不夠長。
+    """
+    timings = []
+    for round_index in range(rounds):
+        for item in corpus:
+            rng = random.Random(round_index)
+            started = time.perf_counter()
+            format_response(item["raw"], rng)
+            timings.append(time.perf_counter() - started)
+    timings.sort()
+
+    outputs = [render(item) for item in corpus]
+    lengths = [len(output) for output in outputs]
+    # 輸出為開場、要點與結尾，以空行分隔
+    short_source = sum(
+        1 for item, output in zip(corpus, outputs)
+        if len(output) < RESPONSE_MIN_CHARS and "…" not in output
+        and len(output.split("\n\n")) - 2 >= len(parse_points(item["raw"]))
+    )
+    return {
+        "replies": len(corpus),
+        "rounds": rounds,
+        "mean_us": round(statistics.mean(timings) * 1e6, 1),
+        "p50_us": round(timings[len(timings) // 2] * 1e6, 1),
+        "p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+        "within_max_chars": sum(1 for n in lengths if n <= RESPONSE_MAX_CHARS),
+        "within_budget": sum(1 for n in lengths if RESPONSE_MIN_CHARS <= n <= RESPONSE_MAX_CHARS),
+        "truncated": sum(1 for output in outputs if "…" in output),
+        "short_source": short_source,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以固定語料檢查 format_response 的輸出與效能")
+    parser.add_argument("command", choices=["check", "update", "bench"],
+                        help="check：比對 golden；update：重新產生 golden；bench：量測耗時與字數")
+    parser.add_argument("--corpus", default=CORPUS_PATH, help="JSONL 語料，每行 id 與 raw（模型原始輸出）")
+    parser.add_argument("--golden", default=GOLDEN_PATH)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    corpus = load_jsonl(args.corpus)
+    if args.command == "check":
+        failures = check(corpus, load_jsonl(args.golden))
+        print(f"{len(corpus) - failures}/{len(corpus)} 筆與 golden 相同")
+        sys.exit(1 if failures else 0)
+    elif args.command == "update":
+        update(corpus, args.golden)
+        print(f"已更新 {args.golden}（{len(corpus)} 筆）")
+    else:
+        json.dump(bench(corpus, args.rounds), sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import datetime
+import threading
+import subprocess
+
+# 使用暫存資料庫與日誌目錄，不影響正式資料
+_workdir = os.environ.get("JOURNAL_CHECK_WORKDIR") or tempfile.mkdtemp(prefix="journal-check-")
+os.environ["JOURNAL_CHECK_WORKDIR"] = _workdir
+os.environ["APP_DATABASE_URL"] = "sqlite:///" + os.path.join(_workdir, "check.db")
+os.environ["JOURNAL_DIR"] = os.path.join(_workdir, "journal")
+for _name in ("OPENAI_API_KEY", "LINE_CHANNEL_ACCESS_TOKEN", "LINE_CHANNEL_SECRET"):
+    os.environ.setdefault(_name, "journal-check-stub")
+
+from sqlalchemy import select, func
+from sqlalchemy.exc import OperationalError
+from app import app, db
+from models import User, Conversation, ConversationRollup, upgrade_schema
+from analytics import TOTAL
+from conversation_journal import ConversationJournal, JOURNAL_DIR
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 子行程附加後直接結束、不 flush 的筆數
+CRASH_ROWS = 20
+
+
+def _journal(**kwargs):
+    # flush 間隔設得很長，只在檢查明確呼叫 flush() 時寫入
+    kwargs.setdefault("flush_interval_ms", 3600 * 1000)
+    return ConversationJournal(directory=JOURNAL_DIR, **kwargs)
+
+def _counts():
+    """回傳 (對話筆數, 每日 rollup 的對話總數)"""
+    with app.app_context():
+        conversations = db.session.scalar(select(func.count(Conversation.id)))
+        rollups = db.session.scalar(
+            select(func.sum(ConversationRollup.conversations))
+            .where(ConversationRollup.granularity == "day")
+            .where(ConversationRollup.category == TOTAL, ConversationRollup.intent == TOTAL)
+        )
+        return conversations, rollups or 0
+
+def _make_user(line_user_id):
+    with app.app_context():
+        user = User(line_user_id=line_user_id, last_interaction=datetime.datetime(2000, 1, 1))
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+def _last_interaction(user_id):
+    with app.app_context():
+        return db.session.get(User, user_id).last_interaction
+
+def _crash_child(user_id):
+    """子行程：附加 CRASH_ROWS 筆後不經 atexit 直接結束，模擬 worker 當掉"""
+    journal = _journal()
+    for index in range(CRASH_ROWS):
+        journal.append(user_id=user_id, user_message=f"crash {index}", bot_response="ok")
+    os._exit(0)
+
+
+def check_crash_replay():
+    """已結束行程留下的日誌段在 recover() 時全部寫入，並更新 last_interaction"""
+    failures = []
+    user_id = _make_user("U-crash")
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--crash-child", str(user_id)], check=True)
+    segments = [name for name in os.listdir(JOURNAL_DIR) if name.endswith(".jsonl")]
+    if len(segments) != 1:
+        return [f"crashed worker left {len(segments)} segments, expected 1"]
+    shutil.copy(os.path.join(JOURNAL_DIR, segments[0]), os.path.join(_workdir, "replay-copy.jsonl"))
+
+    before = _counts()
+    replayed = _journal().recover()
+    after = _counts()
+    if replayed != CRASH_ROWS:
+        failures.append(f"recover() replayed {replayed} rows, expected {CRASH_ROWS}")
+    if after != (before[0] + CRASH_ROWS, before[1] + CRASH_ROWS):
+        failures.append(f"conversations/rollups went from {before} to {after}, expected +{CRASH_ROWS} each")
+    if os.listdir(JOURNAL_DIR) != []:
+        failures.append(f"journal directory not empty after recover(): {os.listdir(JOURNAL_DIR)}")
+    if _last_interaction(user_id) <= datetime.datetime(2000, 1, 1):
+        failures.append("last_interaction was not advanced by the replayed batch")
+    return failures
+
+def check_idempotent_replay():
+    """重播已寫入的日誌段不應重複寫入對話或重複計入 rollup，也不應讓 last_interaction 倒退"""
+    failures = []
+    user_id = _make_user("U-replay")
+    journal = _journal()
+    for index in range(5):
+        journal.append(user_id=user_id, user_message=f"replay {index}", bot_response="ok")
+    # 在 flush 前保留一份日誌段，模擬提交後、刪檔前當掉
+    segment = journal._segment.path
+    shutil.copy(segment, os.path.join(_workdir, "replay-again.jsonl"))
+    journal.flush()
+    latest = _last_interaction(user_id)
+
+    before = _counts()
+    for _ in range(2):
+        shutil.copy(os.path.join(_workdir, "replay-again.jsonl"), segment)
+        replayed = _journal().recover()
+        if replayed:
+            failures.append(f"replaying a committed segment inserted {replayed} rows, expected 0")
+    if _counts() != before:
+        failures.append(f"conversations/rollups changed from {before} to {_counts()} on replay")
+
+    # 較舊的日誌段（當掉的 worker）重播時不應讓 last_interaction 倒退
+    shutil.copy(os.path.join(_workdir, "replay-copy.jsonl"), segment)
+    with open(segment, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f]
+    with open(segment, "w", encoding="utf-8") as f:
+        for row in rows:
+            row.update(user_id=user_id, journal_id=row["journal_id"] + "-old",
+                       timestamp=(latest - datetime.timedelta(days=1)).isoformat())
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    _journal().recover()
+    if _last_interaction(user_id) != latest:
+        failures.append(f"replaying older rows moved last_interaction from {latest} to {_last_interaction(user_id)}")
+    return failures
+
+def check_transient_failure():
+    """資料庫暫時無法連線時，資料列保留待寫入並持續重試，不應移到 dead-letter"""
+    failures = []
+    user_id = _make_user("U-outage")
+    journal = _journal(max_retries=2)
+    write_rows = journal._write_rows
+    outage = {"left": 5}
+
+    def flaky(rows):
+        if outage["left"]:
+            outage["left"] -= 1
+            raise OperationalError("INSERT", {}, Exception("database is locked"))
+        return write_rows(rows)
+
+    journal._write_rows = flaky
+    for index in range(3):
+        journal.append(user_id=user_id, user_message=f"outage {index}", bot_response="ok")
+    before = _counts()
+    for _ in range(5):
+        if journal.flush():
+            failures.append("flush() reported rows written during the outage")
+    stats = journal.stats()
+    if stats["pending"] != 3 or stats["dead_lettered"]:
+        failures.append(f"during the outage pending={stats['pending']} dead_lettered={stats['dead_lettered']}, "
+                        "expected 3 and 0")
+    if journal.flush() != 3 or _counts() != (before[0] + 3, before[1] + 3):
+        failures.append("rows were not written once the database came back")
+    return failures
+
+def check_poison_row():
+    """一筆永遠失敗的資料列在 max_retries 次後移到 dead-letter，其他資料列照常寫入，append() 不會卡住"""
+    failures = []
+    user_id = _make_user("U-poison")
+    dead_letter_dir = os.path.join(_workdir, "dead-letter")
+    # batch_size 大於 max_pending：背景執行緒只在佇列滿時被喚醒，前三次 flush 由檢查自己呼叫
+    journal = _journal(max_retries=3, max_pending=10, batch_size=20, dead_letter_dir=dead_letter_dir)
+    for index in range(4):
+        journal.append(user_id=user_id, user_message=f"good {index}", bot_response="ok")
+    # user_message 為 NOT NULL，這筆每次寫入都會違反約束
+    journal.append(user_id=user_id, user_message=None, bot_response="ok")
+    for index in range(4, 9):
+        journal.append(user_id=user_id, user_message=f"good {index}", bot_response="ok")
+
+    before = _counts()
+    flushed = [journal.flush() for _ in range(3)]
+    if flushed != [0, 0, 9]:
+        failures.append(f"flushes returned {flushed}, expected [0, 0, 9]")
+    if _counts() != (before[0] + 9, before[1] + 9):
+        failures.append(f"conversations/rollups went from {before} to {_counts()}, expected +9 each")
+    dead = []
+    for name in os.listdir(dead_letter_dir) if os.path.isdir(dead_letter_dir) else []:
+        with open(os.path.join(dead_letter_dir, name), encoding="utf-8") as f:
+            dead += [json.loads(line) for line in f]
+    if len(dead) != 1 or dead[0]["user_message"] is not None or "error" not in dead[0]:
+        failures.append(f"dead-letter holds {dead}, expected the one poison row with its error")
+    if journal.stats()["dead_lettered"] != 1 or journal.stats()["pending"]:
+        failures.append(f"stats after dead-lettering: {journal.stats()}")
+
+    # 佇列已滿時 append() 會等待 flush；有毒資料列被移走後不應無限期卡住
+    journal.flush_interval = 0.05
+    journal.append(user_id=user_id, user_message=None, bot_response="ok")
+    done = threading.Event()
+
+    def fill():
+        for index in range(20):
+            journal.append(user_id=user_id, user_message=f"after {index}", bot_response="ok")
+        done.set()
+
+    threading.Thread(target=fill, daemon=True).start()
+    if not done.wait(10):
+        failures.append("append() still blocked 10s after the queue filled behind a poison row")
+    journal.flush()
+    if journal.stats()["dead_lettered"] != 2:
+        failures.append(f"second poison row not dead-lettered: {journal.stats()}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="檢查對話日誌的當機重播、重播冪等與寫入失敗時的處理")
+    parser.add_argument("--crash-child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.crash_child is not None:
+        _crash_child(args.crash_child)
+
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+
+    failed = False
+    checks = {
+        "crash replay": check_crash_replay,
+        "idempotent replay": check_idempotent_replay,
+        "flush during outage": check_transient_failure,
+        "flush with a poison row": check_poison_row,
+    }
+    for name, check in checks.items():
+        failures = check()
+        print(f"{name}: {'OK' if not failures else 'FAILED'}")
+        for failure in failures:
+            print(f"  {failure}")
+        failed = failed or bool(failures)
+    shutil.rmtree(_workdir, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    # 失敗情境會刻意觸發日誌錯誤訊息；app 匯入時已設定根 logger
+    logging.getLogger().setLevel(logging.CRITICAL)
+    main()
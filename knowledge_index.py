@@ -0,0 +1,385 @@
+import os
+import re
+import json
+import math
+import mmap
+import array
+import logging
+import argparse
+import threading
+from collections import Counter, defaultdict
+import numpy as np
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+KNOWLEDGE_INDEX_DIR = os.environ.get("KNOWLEDGE_INDEX_DIR", os.path.join(basedir, "knowledge_index"))
+KNOWLEDGE_TOP_K = int(os.environ.get("KNOWLEDGE_TOP_K", "3"))
+KNOWLEDGE_TOKEN_BUDGET = int(os.environ.get("KNOWLEDGE_TOKEN_BUDGET", "600"))
+
+# 與 openai_service.classify_question 的分類標籤一致
+CATEGORIES = ["ISO14064-1", "ISO14064-2", "ISO14064-3", "ISO14067", "ISO14068-1",
+              "SBTi", "WBCSD", "TaiwanReg", "General"]
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# BM25 參數
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_CJK_RE = re.compile(r"[㐀-鿿豈-﫿]+")
+_WORD_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9.\-]*")
+
+
+def tokenize(text):
+    """
+    將文字切成檢索用詞彙：中文取相鄰二字（bigram，單獨一個字則取該字），英數取整個單字（小寫）。
+    不需要斷詞字典，建索引與查詢使用相同規則即可。不收單字是因為常用字幾乎出現在每個段落，
+    posting list 很長卻幾乎不影響排序。
+    """
+    tokens = []
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(word.lower() for word in _WORD_RE.findall(text))
+    return tokens
+
+
+def estimate_tokens(text):
+    """粗估 LLM token 數：中文約一字一 token，英數約四字元一 token。"""
+    cjk = sum(len(run) for run in _CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def split_passages(text, max_chars=400):
+    """依段落切分文件，過長的段落再依句號切成不超過 max_chars 的片段。"""
+    passages = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            passages.append(paragraph)
+            continue
+        current = ""
+        for sentence in re.split(r"(?<=[。！？.!?])", paragraph):
+            if current and len(current) + len(sentence) > max_chars:
+                passages.append(current.strip())
+                current = ""
+            current += sentence
+        if current.strip():
+            passages.append(current.strip())
+    return passages
+
+
+class KnowledgeIndex:
+    """
+    本地標準條文檢索索引。
+
+    索引目錄內容（由 build_index 離線產生）：
+    - index.json：段落文字、來源、分類，以及 BM25 倒排索引
+    - embeddings.f32（選用）：段落向量，float32 連續排列，查詢時以 mmap 讀取
+
+    每個詞彙的 posting list 在第一次被查詢時轉成 numpy 陣列並依分類拆開，
+    同時預先算好每筆的 BM25 權重；查詢只需把相關分類的權重以 bincount 累加。
+    """
+
+    def __init__(self, index_dir=KNOWLEDGE_INDEX_DIR):
+        with open(os.path.join(index_dir, "index.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        self.passages = data["passages"]
+        self._raw_postings = data["postings"]
+        self.avgdl = data["avgdl"] or 1.0
+        self.dimensions = data.get("dimensions")
+        self.categories = np.array([passage["category"] for passage in self.passages])
+        doc_lengths = np.asarray(data["doc_lengths"], dtype=np.float32)
+        # BM25 分母中與詞頻無關的部分
+        self._length_norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / self.avgdl)
+        # term -> {category: (doc_ids, BM25 權重)}，查詢時才建立
+        self._postings = {}
+
+        self.embeddings = None
+        embeddings_path = os.path.join(index_dir, "embeddings.f32")
+        if self.dimensions and os.path.exists(embeddings_path):
+            with open(embeddings_path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.embeddings = np.frombuffer(self._mmap, dtype=np.float32).reshape(-1, self.dimensions)
+
+    def _term_postings(self, term):
+        postings = self._postings.get(term)
+        if postings is None:
+            plist = self._raw_postings.get(term)
+            if not plist:
+                return None
+            n = len(self.passages)
+            doc_ids = np.fromiter((doc_id for doc_id, _ in plist), dtype=np.int32, count=len(plist))
+            tf = np.fromiter((tf for _, tf in plist), dtype=np.float32, count=len(plist))
+            idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            weights = idf * tf * (BM25_K1 + 1) / (tf + self._length_norm[doc_ids])
+            categories = self.categories[doc_ids]
+            postings = {}
+            for category in np.unique(categories):
+                mask = categories == category
+                postings[str(category)] = (doc_ids[mask], weights[mask])
+            self._postings[term] = postings
+        return postings
+
+    def bm25(self, query, categories=None):
+        """回傳每個段落的 BM25 分數陣列（未命中為 0），categories 為可選的分類清單。"""
+        doc_ids, weights = [], []
+        for term, qtf in Counter(tokenize(query)).items():
+            postings = self._term_postings(term)
+            if postings is None:
+                continue
+            for category in (postings if categories is None else categories):
+                if category in postings:
+                    doc_ids.append(postings[category][0])
+                    weights.append(postings[category][1] * qtf)
+        if not doc_ids:
+            return np.zeros(len(self.passages))
+        return np.bincount(np.concatenate(doc_ids), weights=np.concatenate(weights), minlength=len(self.passages))
+
+    def _rerank(self, candidates, feedback=3, weight=0.3):
+        """
+        以向量重新排序 BM25 候選段落。查詢本身不做 embedding（避免網路呼叫），
+        而是以前幾名段落向量的平均作為查詢向量（pseudo-relevance feedback）。
+        """
+        doc_ids = np.array([doc_id for doc_id, _ in candidates])
+        scores = np.array([score for _, score in candidates])
+        centroid = self.embeddings[doc_ids[:feedback]].sum(axis=0)
+        centroid /= np.linalg.norm(centroid) or 1.0
+        cosine = self.embeddings[doc_ids] @ centroid
+        combined = (1 - weight) * scores / (scores[0] or 1.0) + weight * cosine
+        order = np.argsort(-combined, kind="stable")
+        return [(int(doc_ids[i]), float(combined[i])) for i in order]
+
+    def search(self, query, category=None, top_k=KNOWLEDGE_TOP_K, token_budget=KNOWLEDGE_TOKEN_BUDGET):
+        """
+        取出與查詢最相關的段落，限定在該分類（以及通用 General 文件）內，
+        並在 token_budget 內盡量放入 top_k 段。
+        """
+        categories = None
+        if category and category != "General":
+            categories = [category, "General"]
+
+        scores = self.bm25(query, categories)
+        limit = max(top_k * 5, 20)
+        hits = np.flatnonzero(scores)
+        if len(hits) > limit:
+            hits = hits[np.argpartition(-scores[hits], limit - 1)[:limit]]
+        candidates = sorted(((int(doc_id), float(scores[doc_id])) for doc_id in hits),
+                            key=lambda item: item[1], reverse=True)
+        if not candidates:
+            return []
+        if self.embeddings is not None and len(candidates) > 1:
+            candidates = self._rerank(candidates)
+
+        results = []
+        used = 0
+        for doc_id, score in candidates:
+            passage = self.passages[doc_id]
+            cost = estimate_tokens(passage["text"])
+            if used + cost > token_budget:
+                continue
+            results.append(dict(passage, score=round(score, 4)))
+            used += cost
+            if len(results) >= top_k:
+                break
+        return results
+
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+def get_index():
+    """載入並快取索引；若尚未建立索引則回傳 None。"""
+    global _index, _index_loaded
+    if not _index_loaded:
+        with _index_lock:
+            if not _index_loaded:
+                try:
+                    _index = KnowledgeIndex()
+                    logger.info("Knowledge index loaded: %d passages", len(_index.passages))
+                except FileNotFoundError:
+                    logger.info("Knowledge index not found, retrieval disabled")
+                except Exception as e:
+                    logger.error("Error loading knowledge index: %s", e)
+                _index_loaded = True
+    return _index
+
+def retrieve_passages(query, category, top_k=KNOWLEDGE_TOP_K, token_budget=KNOWLEDGE_TOKEN_BUDGET):
+    """檢索相關標準條文；索引不存在或發生錯誤時回傳空清單。"""
+    index = get_index()
+    if index is None:
+        return []
+    try:
+        return index.search(query, category, top_k=top_k, token_budget=token_budget)
+    except Exception as e:
+        logger.error("Error retrieving passages: %s", e)
+        return []
+
+
+def build_index(source_dir, index_dir=KNOWLEDGE_INDEX_DIR, with_embeddings=False, max_chars=400):
+    """
+    離線建立索引。source_dir 下每個子目錄名稱即為分類標籤（例如 ISO14064-1/、TaiwanReg/），
+    其中的 .txt / .md 檔案會被切成段落；不屬於任何分類的檔案歸為 General。
+    """
+    passages = []
+    for root, _, files in os.walk(source_dir):
+        relative = os.path.relpath(root, source_dir)
+        category = relative.split(os.sep)[0] if relative != "." else "General"
+        if category not in CATEGORIES:
+            logger.warning("Unknown category directory '%s', treated as General", category)
+            category = "General"
+        for name in sorted(files):
+            if not name.endswith((".txt", ".md")):
+                continue
+            with open(os.path.join(root, name), encoding="utf-8") as f:
+                text = f.read()
+            source = os.path.splitext(name)[0]
+            for passage in split_passages(text, max_chars=max_chars):
+                passages.append({"text": passage, "source": source, "category": category})
+
+    postings = defaultdict(list)
+    doc_lengths = []
+    for doc_id, passage in enumerate(passages):
+        counts = Counter(tokenize(passage["text"]))
+        doc_lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            postings[term].append([doc_id, tf])
+
+    dimensions = None
+    os.makedirs(index_dir, exist_ok=True)
+    if with_embeddings and passages:
+        from openai_service import openai
+        vectors = array.array("f")
+        for start in range(0, len(passages), 100):
+            batch = [p["text"] for p in passages[start:start + 100]]
+            response = openai.embeddings.create(model=EMBEDDING_MODEL, input=batch)
+            for item in response.data:
+                norm = math.sqrt(sum(v * v for v in item.embedding)) or 1.0
+                vectors.extend(v / norm for v in item.embedding)
+                dimensions = len(item.embedding)
+        with open(os.path.join(index_dir, "embeddings.f32"), "wb") as f:
+            vectors.tofile(f)
+
+    with open(os.path.join(index_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "passages": passages,
+            "postings": postings,
+            "doc_lengths": doc_lengths,
+            "avgdl": sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0,
+            "dimensions": dimensions,
+        }, f, ensure_ascii=False)
+
+    logger.info("Built knowledge index with %d passages in %s", len(passages), index_dir)
+    return len(passages)
+
+
+def build_synthetic_index(index_dir, passages=10000, dimensions=1536, seed=0):
+    """
+    產生合成語料並建立索引（含隨機向量），用於量測檢索延遲。
+    詞彙出現頻率依 Zipf 分佈，回傳 (vocab, weights) 供產生查詢。
+    """
+    import random
+    import tempfile
+
+    rng = random.Random(seed)
+    chars = [chr(code) for code in range(0x4E00, 0x4E00 + 3000)]
+    vocab = ["".join(rng.choice(chars) for _ in range(rng.randint(2, 4))) for _ in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocab))]
+
+    with tempfile.TemporaryDirectory() as source_dir:
+        per_file = 50
+        for file_no in range(max(passages // per_file, 1)):
+            category = CATEGORIES[file_no % len(CATEGORIES)]
+            os.makedirs(os.path.join(source_dir, category), exist_ok=True)
+            paragraphs = ["，".join(rng.choices(vocab, weights, k=rng.randint(40, 90))) + "。"
+                          for _ in range(per_file)]
+            with open(os.path.join(source_dir, category, f"doc{file_no}.txt"), "w", encoding="utf-8") as f:
+                f.write("\n\n".join(paragraphs))
+        count = build_index(source_dir, index_dir)
+
+    vectors = np.random.default_rng(seed).standard_normal((count, dimensions), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors.tofile(os.path.join(index_dir, "embeddings.f32"))
+    with open(os.path.join(index_dir, "index.json"), encoding="utf-8") as f:
+        data = json.load(f)
+    data["dimensions"] = dimensions
+    with open(os.path.join(index_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    return vocab, weights
+
+def bench(index, queries, categories=("ISO14064-1", "General")):
+    """
+    量測查詢延遲（毫秒）。第一輪包含詞彙 posting list 第一次被查詢時的轉換成本（cold），
+    第二輪為轉換完成後的穩定狀態（warm）。
+    """
+    import time
+    import statistics
+
+    report = {}
+    for phase in ("cold", "warm"):
+        for category in categories:
+            timings = []
+            for query in queries:
+                started = time.perf_counter()
+                index.search(query, category)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            report[f"{phase} {category}"] = {
+                "mean_ms": round(statistics.mean(timings), 2),
+                "p50_ms": round(timings[len(timings) // 2], 2),
+                "p99_ms": round(timings[int(len(timings) * 0.99)], 2),
+            }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="建立或查詢本地 ESG 標準檢索索引")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="從文件目錄離線建立索引")
+    build_parser.add_argument("source_dir")
+    build_parser.add_argument("--out", default=KNOWLEDGE_INDEX_DIR)
+    build_parser.add_argument("--embeddings", action="store_true", help="以 OpenAI 計算段落向量")
+    build_parser.add_argument("--max-chars", type=int, default=400)
+
+    query_parser = subparsers.add_parser("query", help="測試查詢")
+    query_parser.add_argument("text")
+    query_parser.add_argument("--category")
+    query_parser.add_argument("--index", default=KNOWLEDGE_INDEX_DIR)
+    query_parser.add_argument("--top-k", type=int, default=KNOWLEDGE_TOP_K)
+
+    bench_parser = subparsers.add_parser("bench", help="以合成語料量測查詢延遲")
+    bench_parser.add_argument("--passages", type=int, default=10000)
+    bench_parser.add_argument("--dimensions", type=int, default=1536)
+    bench_parser.add_argument("--queries", type=int, default=200)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "build":
+        build_index(args.source_dir, args.out, with_embeddings=args.embeddings, max_chars=args.max_chars)
+    elif args.command == "bench":
+        import random
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            vocab, weights = build_synthetic_index(index_dir, args.passages, args.dimensions)
+            rng = random.Random(1)
+            queries = ["".join(rng.choices(vocab, weights, k=3)) + "是什麼" for _ in range(args.queries)]
+            report = bench(KnowledgeIndex(index_dir), queries)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        index = KnowledgeIndex(args.index)
+        for passage in index.search(args.text, args.category, top_k=args.top_k):
+            print(f"[{passage['source']} | {passage['category']} | {passage['score']}]\n{passage['text']}\n")
+
+
+if __name__ == "__main__":
+    main()
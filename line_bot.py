@@ -1,7 +1,9 @@
 import os
+import json
 import logging
 from linebot import LineBotApi, WebhookHandler
-from linebot.models import TextSendMessage
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage, Error
 
 # LINE Bot credentials
 CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
@@ -14,6 +16,9 @@ handler = WebhookHandler(CHANNEL_SECRET)
 # Setup logging
 logger = logging.getLogger(__name__)
 
+# Maximum number of recipients per multicast call allowed by LINE
+MULTICAST_LIMIT = 500
+
 def send_message(user_id, message):
     """
     Send a message to a specific LINE user.
@@ -35,6 +40,44 @@ def send_message(user_id, message):
         logger.error(f"Error sending message: {e}")
         return False
 
+def send_multicast(user_ids, message, retry_key=None):
+    """
+    Send the same message to several LINE users in one API call.
+    
+    Unlike send_message, errors are raised so the caller can decide whether
+    to retry (see broadcast.py). The request is built here instead of with
+    LineBotApi.multicast, which stores the retry key in the client's shared
+    headers: concurrent calls would overwrite each other's key, and later
+    calls of any kind would keep sending it.
+    
+    Args:
+        user_ids (list): Up to MULTICAST_LIMIT LINE user IDs
+        message (str): Message to send
+        retry_key (str): UUID that makes retries of the same call idempotent
+    
+    Returns:
+        str: The x-line-request-id of the accepted request
+    """
+    if len(user_ids) > MULTICAST_LIMIT:
+        raise ValueError(f"multicast accepts at most {MULTICAST_LIMIT} recipients")
+    headers = {k: v for k, v in line_bot_api.headers.items() if k != "X-Line-Retry-Key"}
+    headers["Content-Type"] = "application/json"
+    if retry_key:
+        headers["X-Line-Retry-Key"] = retry_key
+    data = {"to": user_ids, "messages": [TextSendMessage(text=message).as_json_dict()]}
+    response = line_bot_api.http_client.post(
+        line_bot_api.endpoint + "/v2/bot/message/multicast", headers=headers, data=json.dumps(data)
+    )
+    if not 200 <= response.status_code < 300:
+        raise LineBotApiError(
+            status_code=response.status_code,
+            headers=dict(response.headers.items()),
+            request_id=response.headers.get("X-Line-Request-Id"),
+            accepted_request_id=response.headers.get("X-Line-Accepted-Request-Id"),
+            error=Error.new_from_json_dict(response.json)
+        )
+    return response.headers.get("X-Line-Request-Id")
+
 def get_profile(user_id):
     """
     Get profile information for a LINE user.
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+MODES = ["before", "after-info", "after-debug"]
+
+BODY = json.dumps({
+    "destination": "U" + "0" * 32,
+    "events": [{
+        "type": "message", "mode": "active", "timestamp": 1760000000000,
+        "webhookEventId": "01J" + "A" * 23, "replyToken": "r" * 32,
+        "source": {"type": "user", "userId": "U" + "1" * 32},
+        "message": {"id": "5" * 18, "type": "text", "text": "請問範疇三的排放要怎麼計算？我們是電子業的供應商。"},
+    }],
+}, ensure_ascii=False)
+USER_MESSAGE = "請問範疇三的排放要怎麼計算？我們是電子業的供應商。"
+AI_RESPONSE = "您好！範疇三涵蓋價值鏈上下游的間接排放。\n✅ 先盤點採購商品與服務。\n📌 依 GHG Protocol 十五個類別篩選重大項目。\n請問貴公司目前是否已完成範疇一、二盤查？" * 2
+
+
+class _Conversation:
+    """模擬 ORM 物件：舊寫法的 f-string 每次都會呼叫 __repr__"""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return f"<Conversation {self.__dict__}>"
+
+
+def request_before(log):
+    """改版前一則訊息在請求執行緒上的日誌呼叫（basicConfig、f-string、直接寫入 stderr）"""
+    user_id = "U" + "1" * 32
+    log.debug(f"Request body: {BODY}")
+    log.debug(f"Received message from {user_id}: {USER_MESSAGE}")
+    log.info(f"Found {3} recent summaries")
+    log.info(f"Recognized intent: {'professional'}")
+    log.info(f"Question category: {'ISO14064-1'}")
+    log.info(f"Raw GPT response generated: {len(AI_RESPONSE)} chars")
+    log.info(f"Formatted response: {len(AI_RESPONSE)} chars")
+    log.debug(f"AI response: {AI_RESPONSE}")
+    conversation = _Conversation(user_id=1, user_message=USER_MESSAGE, bot_response=AI_RESPONSE)
+    log.debug(f"Saved conversation: {conversation}")
+
+def request_after(log):
+    """改版後的日誌呼叫：延遲格式化，payload 以 SAMPLED 取樣"""
+    from logging_config import new_request_id, new_correlation_id, SAMPLED
+    new_request_id()
+    log.debug("Request body: %s", BODY, extra=SAMPLED)
+    new_correlation_id("01J" + "A" * 23)
+    log.debug("Received message from %s: %s", "U" + "1" * 32, USER_MESSAGE, extra=SAMPLED)
+    log.info("Found %d recent summaries", 3)
+    log.info("Recognized intent: %s", "professional")
+    log.info("Question category: %s", "ISO14064-1")
+    log.info("Raw GPT response generated: %d chars", len(AI_RESPONSE))
+    log.info("Formatted response: %d chars", len(AI_RESPONSE))
+    log.debug("AI response: %s", AI_RESPONSE, extra=SAMPLED)
+    log.debug("Journaled %d messages, last %s", 1, "0" * 32)
+
+def run_mode(mode, requests, io_wait):
+    """在目前行程中設定日誌並量測；只計算請求執行緒花在日誌呼叫上的時間"""
+    if mode == "before":
+        logging.basicConfig(level=logging.DEBUG)
+        simulate = request_before
+    else:
+        from logging_config import setup_logging
+        setup_logging(level="DEBUG" if mode == "after-debug" else "INFO", fmt="json")
+        simulate = request_after
+    log = logging.getLogger("bench")
+
+    for _ in range(50):
+        simulate(log)
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        simulate(log)
+        timings.append(time.perf_counter() - started)
+        # 模擬等待 OpenAI 與資料庫的 I/O，背景執行緒在這段時間寫出日誌
+        time.sleep(io_wait)
+    timings.sort()
+    return {
+        "mode": mode,
+        "requests": requests,
+        "mean_us": round(statistics.mean(timings) * 1e6, 1),
+        "p50_us": round(timings[len(timings) // 2] * 1e6, 1),
+        "p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+    }
+
+def run_all(requests, io_wait, repeats):
+    """每種設定各以新的子行程執行（stderr 導向暫存檔），重複 repeats 次取中位數"""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="logging-benchmark-") as workdir:
+        for mode in MODES:
+            runs = []
+            for index in range(repeats):
+                with open(os.path.join(workdir, f"{mode}-{index}.log"), "w") as stderr:
+                    output = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), "--mode", mode,
+                         "--requests", str(requests), "--io-wait", str(io_wait)],
+                        stdout=subprocess.PIPE, stderr=stderr, check=True, text=True
+                    ).stdout
+                runs.append(json.loads(output))
+            result = {"mode": mode, "requests": requests, "repeats": repeats}
+            for key in ("mean_us", "p50_us", "p99_us"):
+                result[key] = statistics.median(run[key] for run in runs)
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="量測每則訊息的日誌呼叫在請求執行緒上的耗時（改版前後比較）")
+    parser.add_argument("--mode", choices=MODES, help="只在目前行程執行單一設定（供子行程使用）")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--io-wait", type=float, default=0.002, help="每則訊息之間模擬的 I/O 等待秒數")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.mode:
+        json.dump(run_mode(args.mode, args.requests, args.io_wait), sys.stdout)
+        return
+    for result in run_all(args.requests, args.io_wait, args.repeats):
+        print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import uuid
+import atexit
+import random
+import logging
+import datetime
+import threading
+import contextvars
+import collections
+from logging.handlers import QueueHandler
+
+# Logging configuration
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+# Fraction of verbose payload records (logged with extra=SAMPLED) that are kept
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+# Records waiting to be written; when full, new records are dropped instead of blocking
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# How often the writer thread wakes to write queued records
+LOG_FLUSH_INTERVAL_MS = int(os.environ.get("LOG_FLUSH_INTERVAL_MS", "50"))
+
+# Pass as extra= to mark a record as a sampled payload log
+SAMPLED = {"sampled": True}
+
+# The webhook request being handled, and the LINE event within it (one request carries several events)
+_request_id = contextvars.ContextVar("request_id", default=None)
+_correlation_id = contextvars.ContextVar("correlation_id", default=None)
+
+# Attributes every LogRecord has; anything else came from extra= and is emitted as a field
+_RESERVED_ATTRS = set(vars(logging.makeLogRecord({}))) | {
+    "message", "asctime", "request_id", "correlation_id", "sampled"
+}
+
+
+def new_request_id(value=None):
+    """Start a new request id for the current HTTP request and return it; clears the event id."""
+    request_id = value or uuid.uuid4().hex
+    _request_id.set(request_id)
+    _correlation_id.set(None)
+    return request_id
+
+def new_correlation_id(value=None):
+    """Start a new correlation id for the current LINE event and return it; the request id is kept."""
+    correlation_id = value or uuid.uuid4().hex
+    _correlation_id.set(correlation_id)
+    return correlation_id
+
+def get_request_id():
+    return _request_id.get()
+
+def get_correlation_id():
+    return _correlation_id.get()
+
+
+class CorrelationIdFilter(logging.Filter):
+    """Attach the current request and correlation ids; runs on the calling thread, before the queue."""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        record.correlation_id = _correlation_id.get()
+        return True
+
+
+class PayloadSamplingFilter(logging.Filter):
+    """Keep only a fraction of the records marked with extra=SAMPLED."""
+
+    def __init__(self, rate=LOG_PAYLOAD_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False):
+            return random.random() < self.rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including extra= fields and the correlation id."""
+
+    def format(self, record):
+        data = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("request_id", "correlation_id"):
+            value = getattr(record, key, None)
+            if value:
+                data[key] = value
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _LogWriter(threading.Thread):
+    """
+    Writes queued records every LOG_FLUSH_INTERVAL_MS instead of waking for
+    each one, so the request thread never hands the GIL to the writer in the
+    middle of a request.
+    """
+
+    def __init__(self, records, handler, interval=LOG_FLUSH_INTERVAL_MS / 1000):
+        super().__init__(name="log-writer", daemon=True)
+        self.records = records
+        self.handler = handler
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.drain()
+        self.drain()
+
+    def drain(self):
+        while self.records:
+            record = self.records.popleft()
+            if record.levelno >= self.handler.level:
+                self.handler.handle(record)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler that only resolves the message text on the calling thread.
+    Serializing and writing happen on the writer thread. It is the only
+    handler on the root logger, so records are modified in place.
+
+    The writer is started by the first record each process logs: its
+    thread does not survive fork (e.g. gunicorn --preload), and forked
+    children that never log, such as multiprocessing pool workers, do not
+    get a thread of their own.
+    """
+
+    dropped = 0
+
+    def __init__(self, handler, maxsize=LOG_QUEUE_SIZE):
+        super().__init__(collections.deque())
+        self.target = handler
+        self.maxsize = maxsize
+        self.writer = None
+        self._pid = None
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Forked: the parent's pending records are its own to write
+                self.queue = collections.deque()
+            self.writer = _LogWriter(self.queue, self.target)
+            self.writer.start()
+            atexit.register(self.writer.stop)
+            self._pid = os.getpid()
+
+    def enqueue(self, record):
+        self._ensure_writer()
+        # deque.append is atomic; the size check is approximate, which is fine for a drop limit
+        if len(self.queue) >= self.maxsize:
+            self.dropped += 1
+        else:
+            self.queue.append(record)
+
+    def prepare(self, record):
+        # Resolve now: args may reference objects that change after the call
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_handler = None
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """
+    Route all logging through a queue so log I/O happens off the request thread.
+    Safe to call more than once; only the first call configures logging.
+    """
+    global _handler
+    if _handler is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if fmt == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s [%(request_id)s/%(correlation_id)s] %(message)s"
+        ))
+
+    _handler = _NonBlockingQueueHandler(stream_handler)
+    _handler.addFilter(CorrelationIdFilter())
+    _handler.addFilter(PayloadSamplingFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    root.setLevel(level)
@@ -1,13 +1,17 @@
 import logging
 from app import app, db  # Import db also
 
-# Set up logging for easier debugging
-logging.basicConfig(level=logging.DEBUG)
-
 # Create tables
 with app.app_context():
-    from models import User, Conversation  # Import models
+    from models import User, Conversation, upgrade_schema  # Import models
     db.create_all()
+    upgrade_schema()
+    # Rollup tables added to an existing database start empty; fill them from the conversations
+    from analytics import ensure_rollups
+    ensure_rollups()
+    # Insert conversations journaled by a worker that exited before flushing them
+    from conversation_journal import get_journal
+    get_journal().recover()
     logging.debug("Database tables created or verified.")
 
 if __name__ == "__main__":
@@ -1,7 +1,11 @@
+import json
 import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Date
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, ForeignKey, Date, Boolean, UniqueConstraint, inspect, text
 from app import db
 
+# 延遲分布的直方圖上界（毫秒），最後一格收納所有更慢的請求
+LATENCY_BUCKETS_MS = [100, 250, 500, 750, 1000, 1500, 2000, 3000, 4000, 5000, 7500, 10000, 15000, 30000, 60000]
+
 class DailySummary(db.Model):
     """Model for daily conversation summaries"""
     __tablename__ = 'daily_summary'
@@ -10,6 +14,8 @@ class DailySummary(db.Model):
     summary_date = Column(Date, unique=True, nullable=False)
     summary_content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, nullable=True, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    prompt_version = Column(Integer, nullable=True)
     
     def __repr__(self):
         return f"<DailySummary {self.summary_date}>"
@@ -38,6 +44,160 @@ class Conversation(db.Model):
     user_message = Column(Text, nullable=False)
     bot_response = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    # Id assigned when the write was journaled; makes journal replay idempotent
+    journal_id = Column(String(36), unique=True, nullable=True)
+    # Message answered together with a later one in the same burst; it has no reply of its own
+    merged = Column(Boolean, nullable=True)
+    
+    # Pipeline metadata computed by generate_response
+    intent = Column(String(20), nullable=True)
+    category = Column(String(50), nullable=True)
+    needs_followup = Column(Boolean, nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    total_tokens = Column(Integer, nullable=True)
+    # Prompt tokens served from OpenAI's prompt cache
+    cached_tokens = Column(Integer, nullable=True)
+    latency_ms = Column(Integer, nullable=True)
+    
+    def __repr__(self):
+        return f"<Conversation {self.id}>"
+
+class ConversationRollup(db.Model):
+    """
+    Incrementally maintained conversation statistics per time bucket.
+    
+    granularity is "hour", "day" or "all" (a single all-time bucket). Rows with
+    category="*" and intent="*" hold the totals of the bucket, including the
+    number of distinct active users.
+    """
+    __tablename__ = 'conversation_rollups'
+    __table_args__ = (UniqueConstraint('granularity', 'bucket_start', 'category', 'intent'),)
+    
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String(10), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    category = Column(String(50), nullable=False, default="*")
+    intent = Column(String(20), nullable=False, default="*")
+    conversations = Column(Integer, nullable=False, default=0)
+    followups = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(BigInteger, nullable=False, default=0)
+    completion_tokens = Column(BigInteger, nullable=False, default=0)
+    total_tokens = Column(BigInteger, nullable=False, default=0)
+    latency_ms_total = Column(BigInteger, nullable=False, default=0)
+    latency_histogram = Column(Text, nullable=False, default="[]")
+    active_users = Column(Integer, nullable=False, default=0)
+    # Nullable so upgrade_schema can add it to existing tables
+    cached_tokens = Column(BigInteger, nullable=True, default=0)
+    
+    @property
+    def avg_latency_ms(self):
+        return round(self.latency_ms_total / self.conversations) if self.conversations else 0
+    
+    def latency_percentile(self, percentile):
+        """
+        Upper bound of the histogram bucket containing the given percentile,
+        or None if it falls in the overflow bucket above the largest bound.
+        """
+        counts = json.loads(self.latency_histogram or "[]")
+        total = sum(counts)
+        if not total:
+            return 0
+        threshold = total * percentile / 100
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else None
+        return None
+    
+    @property
+    def p95_latency_ms(self):
+        return self.latency_percentile(95)
+    
+    @property
+    def p95_latency_label(self):
+        """p95 for display; the overflow bucket is shown as ">60000"."""
+        p95 = self.p95_latency_ms
+        return f">{LATENCY_BUCKETS_MS[-1]}" if p95 is None else p95
+    
+    @property
+    def cache_hit_rate(self):
+        """Share of prompt tokens served from OpenAI's prompt cache."""
+        return round((self.cached_tokens or 0) / self.prompt_tokens, 3) if self.prompt_tokens else 0.0
+    
+    def __repr__(self):
+        return f"<ConversationRollup {self.granularity} {self.bucket_start} {self.category}/{self.intent}>"
+
+class RollupUser(db.Model):
+    """Users already counted as active in a rollup bucket"""
+    __tablename__ = 'rollup_users'
+    __table_args__ = (UniqueConstraint('granularity', 'bucket_start', 'user_id'),)
+    
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String(10), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+
+class BroadcastJob(db.Model):
+    """Model for a bulk message delivery to many LINE users"""
+    __tablename__ = 'broadcast_jobs'
+    
+    id = Column(Integer, primary_key=True)
+    message = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default="pending")
+    total_recipients = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
     
     def __repr__(self):
-        return f"<Conversation {self.id}>"
\ No newline at end of file
+        return f"<BroadcastJob {self.id} {self.status}>"
+
+class BroadcastBatch(db.Model):
+    """One multicast call (up to 500 recipients) of a broadcast job"""
+    __tablename__ = 'broadcast_batches'
+    __table_args__ = (UniqueConstraint('job_id', 'batch_index'),)
+    
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id', ondelete='CASCADE'), nullable=False)
+    batch_index = Column(Integer, nullable=False)
+    recipients = Column(Text, nullable=False)  # JSON list of LINE user ids
+    recipient_count = Column(Integer, nullable=False)
+    retry_key = Column(String(36), nullable=False)
+    # When retry_key was first sent; LINE only deduplicates retries for 24 hours after that
+    retry_key_used_at = Column(DateTime, nullable=True)
+    status = Column(String(20), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    request_id = Column(String(100), nullable=True)
+    error = Column(Text, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f"<BroadcastBatch {self.job_id}#{self.batch_index} {self.status}>"
+
+def upgrade_schema():
+    """
+    Add columns introduced after a table was first created.
+    db.create_all() only creates missing tables, so new nullable columns on
+    existing tables are added here with ALTER TABLE.
+    """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+    # ADD COLUMN cannot add the unique constraint that journal replay relies on
+    if inspector.has_table('conversations'):
+        unique = [c["column_names"] for c in inspector.get_unique_constraints('conversations')]
+        unique += [i["column_names"] for i in inspector.get_indexes('conversations') if i["unique"]]
+        if ['journal_id'] not in unique:
+            db.session.execute(text(
+                'CREATE UNIQUE INDEX IF NOT EXISTS ix_conversations_journal_id ON conversations (journal_id)'
+            ))
+    db.session.commit()
\ No newline at end of file
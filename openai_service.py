@@ -1,22 +1,38 @@
 import os
+import re
 import logging
+import time
+import asyncio
 import random
+import hashlib
+import functools
 from datetime import datetime, timedelta
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
 except ImportError:
     logging.error("OpenAI package not installed. Please install it with 'pip install openai'.")
     OpenAI = None
+    AsyncOpenAI = None
+from cache import get_cache
+from knowledge_index import retrieve_passages
 
 # OpenAI API key
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
 # Initialize OpenAI client
 openai = OpenAI(api_key=OPENAI_API_KEY)
+# Async client for async_app; does not open connections until first use
+async_openai = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
+ERROR_REPLY = "抱歉，我暫時無法處理您的請求。請稍後再試。"
+
+# 快取存活時間（秒）
+SUMMARY_CACHE_TTL = int(os.environ.get("SUMMARY_CACHE_TTL", "300"))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+
 # 1. AgentIntentRecognizer: 意圖識別器
 def recognize_intent(user_message):
     """
@@ -179,6 +195,14 @@ def build_knowledge_prompt(category):
     
     return base_prompt + knowledge
 
+def build_reference_prompt(user_message, category):
+    """本地索引存在時，回傳檢索到的相關條文摘錄，否則回傳空字串"""
+    passages = retrieve_passages(user_message, category)
+    if not passages:
+        return ""
+    excerpts = [f"【{p['source']}】{p['text']}" for p in passages]
+    return "以下是與本題相關的標準條文摘錄，回答時請優先引用並標明出處：\n" + "\n\n".join(excerpts) + "\n"
+
 # 4. AgentSummaryFetcher: 摘要調用器
 def fetch_recent_summaries_if_needed(user_message):
     """
@@ -189,6 +213,11 @@ def fetch_recent_summaries_if_needed(user_message):
     progress_keywords = ["進度", "之前提到", "上次", "繼續", "我們討論過", "前次", "昨天", "前幾天"]
     
     if any(keyword in user_message for keyword in progress_keywords):
+        today = datetime.now().date()
+        cache = get_cache()
+        cached = cache.get("summaries", today.isoformat())
+        if cached is not None:
+            return cached
         try:
             # 惰性導入，避免循環引用
             from app import app, db
@@ -196,7 +225,6 @@ def fetch_recent_summaries_if_needed(user_message):
             
             with app.app_context():
                 # 計算過去三天的日期
-                today = datetime.now().date()
                 three_days_ago = today - timedelta(days=3)
                 
                 # 從數據庫中獲取最近三天的摘要
@@ -207,6 +235,7 @@ def fetch_recent_summaries_if_needed(user_message):
                 
                 if not summaries:
                     logger.info("No recent summaries found")
+                    cache.set("summaries", today.isoformat(), "", ttl=SUMMARY_CACHE_TTL)
                     return ""
                 
                 # 格式化摘要內容
@@ -215,105 +244,160 @@ def fetch_recent_summaries_if_needed(user_message):
                     date_str = summary.summary_date.strftime("%Y-%m-%d")
                     formatted_summaries.append(f"日期: {date_str}\n{summary.summary_content}")
                 
-                logger.info(f"Found {len(summaries)} recent summaries")
-                return "以下是最近的對話摘要，可參考回答當前問題：\n\n" + "\n\n".join(formatted_summaries)
+                logger.info("Found %d recent summaries", len(summaries))
+                summary_context = "以下是最近的對話摘要，可參考回答當前問題：\n\n" + "\n\n".join(formatted_summaries)
+                cache.set("summaries", today.isoformat(), summary_context, ttl=SUMMARY_CACHE_TTL)
+                return summary_context
         except Exception as e:
-            logger.error(f"Error fetching summaries: {e}")
+            logger.error("Error fetching summaries: %s", e)
             return ""
     
     return ""
 
 # 5. AgentResponseFormatter: 回覆風格整理器
-def format_response(raw_response):
+# 回覆字數預算（含開場語、結尾反問與換行），與系統提示中的 200～220 字一致
+RESPONSE_MIN_CHARS = 200
+RESPONSE_MAX_CHARS = 220
+# 要點放不下時在子句處截斷；可用空間少於此字數則改為捨棄該要點
+MIN_POINT_CHARS = 20
+
+# 友善開場語選項
+FRIENDLY_OPENINGS = [
+    "很高興收到您的提問！讓我整理一下重點：",
+    "這個問題很重要，我來幫您分析：",
+    "感謝您的問題，以下是關鍵資訊：",
+    "這是個好問題！讓我為您整理相關要點：",
+    "很高興能協助您釐清這個問題，以下是重點："
+]
+
+# 結尾反問句選項
+CLOSING_QUESTIONS = [
+    "方便分享一下您的產業別，讓我提供更精準的建議嗎？",
+    "您目前面臨的主要挑戰是什麼呢？",
+    "您對這個方向有什麼想法或顧慮嗎？",
+    "是否需要我針對特定環節提供更多細節？",
+    "這些資訊對您有幫助嗎？需要針對哪部分深入說明？"
+]
+
+# Emoji 選項
+POINT_EMOJIS = ["✅", "📌", "🔍", "💡", "🌟", "🔑"]
+
+# 模型當作條列符號的 emoji；※、→ 等一般符號不算，保留在內容中
+_EMOJI = re.compile(
+    "[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B05-\u2B07\u2B1B\u2B1C\u2B50\u2B55"
+    "\u231A\u231B\u23E9-\u23F3\u23F8-\u23FA\u203C\u2049]"
+)
+_BULLET_PREFIX = re.compile(r"^(?:[-*•·‧]|\d+[.)、．]|[（(]\d+[）)]|\d\ufe0f?\u20e3)\s*")
+_GREETINGS = ("您好", "你好", "嗨", "哈囉", "很高興", "感謝", "謝謝", "好問題", "這是個好問題")
+_SENTENCE = re.compile(r"[^。！？!?]+[。！？!?]*")
+
+def _split_emoji(text):
+    """拆出開頭的 emoji，回傳 (emoji 或 None, 其餘內容)"""
+    if _EMOJI.match(text):
+        return text[0], text[1:].lstrip("\ufe0f").strip()
+    return None, text
+
+def parse_points(raw_response):
     """
-    將GPT初步回應轉換成條列式 + emoji強調 + 開場親切語 + 結尾反問。
+    將模型輸出逐行掃描一次，拆成 [(emoji 或 None, 內容)]。
+    去除 Markdown 標記與條列符號，略過標題與以冒號結尾的引言；第一行的問候句與
+    最後一行的問句視為模型自己的開場與結尾（由 format_response 統一加上），
+    問候之後的內容仍保留。模型只寫了一段文字時，改以句子切成要點，問句與其後的回答視為同一點，
+    句首的 emoji 同樣拆出。
     """
-    # 友善開場語選項
-    friendly_openings = [
-        "很高興收到您的提問！讓我整理一下重點：",
-        "這個問題很重要，我來幫您分析：",
-        "感謝您的問題，以下是關鍵資訊：",
-        "這是個好問題！讓我為您整理相關要點：",
-        "很高興能協助您釐清這個問題，以下是重點："
-    ]
-    
-    # 結尾反問句選項
-    closing_questions = [
-        "方便分享一下您的產業別，讓我提供更精準的建議嗎？",
-        "您目前面臨的主要挑戰是什麼呢？",
-        "您對這個方向有什麼想法或顧慮嗎？",
-        "是否需要我針對特定環節提供更多細節？",
-        "這些資訊對您有幫助嗎？需要針對哪部分深入說明？"
-    ]
-    
-    # Emoji 選項
-    emojis = ["✅", "📌", "🔍", "💡", "🌟", "🔑"]
-    
-    try:
-        # 選擇開場語
-        opening = random.choice(friendly_openings)
-        
-        # 處理主體內容：找出要點並加上 emoji
-        # 假設內容可能已經有條列或段落分隔
-        lines = raw_response.split("\n")
-        formatted_points = []
-        content_points = []
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # 跳過可能已經存在的開場白和結尾問句
-            if len(formatted_points) == 0 and ("?" not in line and "！" not in line):
+    lines = [line.strip() for line in raw_response.split("\n")]
+    lines = [line for line in lines if line]
+    last = len(lines) - 1
+
+    points = []
+    for index, line in enumerate(lines):
+        if line.startswith("#") or (line.startswith("**") and line.endswith("**")):
+            continue
+        line = line.replace("**", "")
+        emoji, line = _split_emoji(line)
+        if emoji:
+            bulleted = True
+        else:
+            stripped = _BULLET_PREFIX.sub("", line)
+            bulleted = stripped != line
+            line = stripped
+
+        if not bulleted and last > 0:
+            if line.endswith(("：", ":")):
                 continue
-            if "?" in line and len(line) > 15 and len(content_points) > 0:
+            if index == 0 and line.startswith(_GREETINGS):
+                line = line[len(_SENTENCE.match(line).group()):].strip()
+            elif index == last and line.endswith(("？", "?")):
                 continue
-                
-            # 添加其餘內容作為要點
-            if len(content_points) < 3:  # 最多取3個要點
-                emoji = random.choice(emojis)
-                if not any(emoji in line for emoji in emojis):
-                    content_points.append(f"{emoji} {line}")
-                else:
-                    content_points.append(line)
-        
-        # 選擇結尾反問句
-        closing = random.choice(closing_questions)
-        
-        # 組合最終回覆
-        final_response = f"{opening}\n\n"
-        final_response += "\n\n".join(content_points)
-        final_response += f"\n\n{closing}"
-        
-        # 確保字數在 200-220 之間
-        if len(final_response) < 200:
-            # 太短，擴充內容
-            while len(final_response) < 200 and len(content_points) < 3:
-                # 分析原回覆，找出可能的擴充點
-                more_points = raw_response.split("。")
-                for point in more_points:
-                    if point.strip() and all(p not in point for p in content_points):
-                        emoji = random.choice(emojis)
-                        new_point = f"{emoji} {point.strip()}。"
-                        content_points.append(new_point)
-                        final_response = f"{opening}\n\n"
-                        final_response += "\n\n".join(content_points)
-                        final_response += f"\n\n{closing}"
-                        break
-                break  # 防止無限循環
-                
-        elif len(final_response) > 220:
-            # 太長，縮減內容
-            while len(final_response) > 220 and len(content_points) > 1:
-                content_points.pop()  # 移除最後一個要點
-                final_response = f"{opening}\n\n"
-                final_response += "\n\n".join(content_points)
-                final_response += f"\n\n{closing}"
-        
-        return final_response
+        if line:
+            points.append((emoji, line))
+
+    if len(points) == 1 and points[0][0] is None:
+        sentences = []
+        for sentence in _SENTENCE.findall(points[0][1]):
+            if sentences and sentences[-1].endswith(("？", "?")):
+                sentences[-1] += sentence
+            elif sentence.strip():
+                sentences.append(sentence.strip())
+        # 段落中以 emoji 開頭的句子沿用模型自己的 emoji
+        points = [_split_emoji(sentence) for sentence in sentences]
+    return points
+
+def _truncate(text, room):
+    """將要點截短到 room 字內，優先停在句號或逗號等子句邊界"""
+    if len(text) <= room:
+        return text
+    if room <= 1:
+        return ""
+    cut = text[:room - 1]
+    boundary = max(cut.rfind(mark) for mark in "。！？；，、,;")
+    if boundary < room // 2:
+        # 英文內容沒有子句標點時，至少停在單字之間
+        boundary = cut.rfind(" ")
+    if boundary >= room // 2:
+        cut = cut[:boundary].rstrip()
+    return cut + "…"
+
+def fit_points(points, fixed_chars, min_chars=RESPONSE_MIN_CHARS, max_chars=RESPONSE_MAX_CHARS):
+    """
+    依序挑選要點直到字數預算用完，每個要點只計算一次長度，不限要點數。
+    第一個放不下的要點：尚未達到 min_chars 時在子句處截斷補足，剩餘空間太少則捨棄；
+    已達 min_chars 時停在完整的要點（但至少保留一點）。
+    模型輸出本身不足 min_chars 時無法補足，只保證不超過 max_chars。
+    """
+    chosen = []
+    used = fixed_chars
+    for point in points:
+        separator = 2 if chosen else 0
+        if used + separator + len(point) <= max_chars:
+            chosen.append(point)
+            used += separator + len(point)
+            continue
+        room = max_chars - used - separator
+        if not chosen or (used < min_chars and room >= MIN_POINT_CHARS):
+            chosen.append(_truncate(point, room))
+        break
+    return chosen
+
+def format_response(raw_response, rng=None):
+    """
+    將GPT初步回應轉換成條列式 + emoji強調 + 開場親切語 + 結尾反問，
+    總長不超過 RESPONSE_MAX_CHARS。傳入 random.Random(seed) 可讓開場、結尾與 emoji 固定。
+    """
+    rng = rng or random
+    try:
+        opening = rng.choice(FRIENDLY_OPENINGS)
+        closing = rng.choice(CLOSING_QUESTIONS)
+        points = [
+            f"{emoji or rng.choice(POINT_EMOJIS)} {text}"
+            for emoji, text in parse_points(raw_response)
+        ]
+        # 開場語、結尾反問與兩組空行
+        fixed_chars = len(opening) + len(closing) + 4
+        body = "\n\n".join(fit_points(points, fixed_chars))
+        return f"{opening}\n\n{body}\n\n{closing}" if body else f"{opening}\n\n{closing}"
     except Exception as e:
-        logger.error(f"Error formatting response: {e}")
+        logger.error("Error formatting response: %s", e)
         # 如果格式化失敗，返回原始回覆
         return raw_response
 
@@ -346,6 +430,68 @@ def generate_casual_chat_response(user_message):
     ]
     return random.choice(casual_responses)
 
+# 回覆原則與格式要求（所有分類共用）
+RESPONSE_RULES = """
+🎯 回覆時請掌握以下原則：
+
+1. 回答必須「實事求是、可執行、符合標準」，必要時補充國際標準，但以台灣適用為準。
+2. 若使用者提出的作法在台灣尚未被認定合規，請誠實指出潛在限制，但同時提供可行的替代方式或實務建議。
+3. 面對模糊、不完整的提問，請引導使用者補充關鍵資訊（如產業類別、是否需揭露、是否涉及查證）。
+4. 回答語氣保持專業、親切、有策略性，不需過度保守或逃避問題。
+
+✅ 回覆格式要求：
+1. 回覆字數控制在 200～220 字內
+2. 開頭一句親切友善的句子
+3. 條列重點，通常 2～3 點，每點一兩句，用 emoji（✅ 📌 🔍）開頭每點；若字數仍有餘裕可再列一點，總字數以第 1 點為準
+4. 結尾提出反問，引導對方進一步說明背景或需求
+"""
+
+FOLLOWUP_NOTE = "請特別注意：提問者似乎需要更多引導。請確保在回覆中主動詢問產業類別、組織規模、目標時程等關鍵背景資訊。"
+
+# 輔助函數：每個分類固定的系統提示前綴
+@functools.lru_cache(maxsize=None)
+def build_static_prompt(category):
+    """
+    知識背景加上回覆原則與格式要求。同一分類每次都逐字相同，
+    OpenAI 的 prompt caching 才能重用這段前綴。
+    """
+    return build_knowledge_prompt(category) + "\n" + RESPONSE_RULES
+
+# 輔助函數：組合系統提示
+def build_system_prompt(category, user_message=None, summary_context="", needs_followup=False):
+    """
+    系統提示以分類固定的前綴開頭，檢索條文、摘要、引導提示等每次不同的內容一律放在最後。
+    """
+    parts = [build_static_prompt(category)]
+    if user_message:
+        references = build_reference_prompt(user_message, category)
+        if references:
+            parts.append(references)
+    if summary_context:
+        parts.append(summary_context)
+    if needs_followup:
+        parts.append(FOLLOWUP_NOTE)
+    return "\n".join(parts)
+
+# 輔助函數：Chat Completions 請求參數（同步呼叫與 Batch API 共用）
+def build_chat_request(system_prompt, user_message):
+    # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+    # do not change this unless explicitly requested by the user
+    return {
+        "model": "gpt-4o",
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message}
+        ],
+        "max_tokens": 250,
+        "temperature": 0.55
+    }
+
+def cached_prompt_tokens(usage):
+    """回傳 prompt 中命中 OpenAI prompt caching 的 token 數，未提供時為 0"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
 # 主函數：整合所有Agent
 def generate_response(user_message):
     """
@@ -357,78 +503,129 @@ def generate_response(user_message):
     Returns:
         str: 生成的專業回覆
     """
-    try:
-        # Step 1: 判斷是聊天還是專業問題
-        intent = recognize_intent(user_message)
-        logger.info(f"Recognized intent: {intent}")
-        
-        # Step 2: 如果是普通聊天，簡單回覆
-        if intent == "chat":
-            return generate_casual_chat_response(user_message)
-
-        # Step 3: 專業問題處理流程
-        # (1) 分類問題
-        category = classify_question(user_message)
-        logger.info(f"Question category: {category}")
-        
-        # (2) 檢查是否需要特別引導（問題太模糊）
-        needs_followup = decide_need_followup(user_message)
-        
-        # (3) 構建知識背景 Prompt
-        knowledge_prompt = build_knowledge_prompt(category)
-        
-        # (4) 獲取相關摘要（如有必要）
-        summary_context = fetch_recent_summaries_if_needed(user_message)
-        
-        # (5) 建立最終 Prompt
-        system_prompt = f"""
-{knowledge_prompt}
+    return generate_response_with_metadata(user_message)[0]
 
-🎯 回覆時請掌握以下原則：
-
-1. 回答必須「實事求是、可執行、符合標準」，必要時補充國際標準，但以台灣適用為準。
-2. 若使用者提出的作法在台灣尚未被認定合規，請誠實指出潛在限制，但同時提供可行的替代方式或實務建議。
-3. 面對模糊、不完整的提問，請引導使用者補充關鍵資訊（如產業類別、是否需揭露、是否涉及查證）。
-4. 回答語氣保持專業、親切、有策略性，不需過度保守或逃避問題。
+def generate_response_with_metadata(user_message):
+    """
+    與 generate_response 相同，另外回傳流程中的中間結果，供寫入對話紀錄與統計。
+    
+    Returns:
+        tuple: (回覆文字, metadata)，metadata 包含 intent、category、needs_followup、
+        prompt_tokens、completion_tokens、total_tokens、cached_tokens、latency_ms
+    """
+    started = time.perf_counter()
+    metadata = _new_metadata()
+    reply = _run_pipeline(user_message, metadata)
+    metadata["latency_ms"] = round((time.perf_counter() - started) * 1000)
+    return reply, metadata
 
-✅ 回覆格式要求：
-1. 回覆字數控制在 200～220 字內
-2. 開頭一句親切友善的句子
-3. 條列重點，最多 2～3 點，用 emoji（✅ 📌 🔍）開頭每點
-4. 結尾提出反問，引導對方進一步說明背景或需求
+async def generate_response_with_metadata_async(user_message):
+    """
+    generate_response_with_metadata 的 coroutine 版本，供 async_app 使用。
+    OpenAI 以 AsyncOpenAI 呼叫，等待回覆時不佔用執行緒；分類、檢索、摘要查詢與快取
+    等會阻塞的步驟則交給 event loop 的執行緒池。
+    """
+    started = time.perf_counter()
+    metadata = _new_metadata()
+    try:
+        reply, request, cacheable = await asyncio.to_thread(_prepare, user_message, metadata)
+        if reply is None:
+            response = await async_openai.chat.completions.create(**request)
+            reply = await asyncio.to_thread(_finish, user_message, response, metadata, cacheable)
+    except Exception as e:
+        logger.error("Error generating response: %s", e)
+        reply = ERROR_REPLY
+    metadata["latency_ms"] = round((time.perf_counter() - started) * 1000)
+    return reply, metadata
 
-{summary_context}
-"""
+def _new_metadata():
+    return {
+        "intent": None,
+        "category": None,
+        "needs_followup": False,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+        "cached_tokens": 0,
+        "latency_ms": 0,
+    }
 
-        # 針對需要引導的問題，調整 prompt
-        if needs_followup:
-            system_prompt += "\n請特別注意：提問者似乎需要更多引導。請確保在回覆中主動詢問產業類別、組織規模、目標時程等關鍵背景資訊。"
-        
-        # (6) 呼叫 OpenAI GPT-4o
-        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-        # do not change this unless explicitly requested by the user
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            max_tokens=250,
-            temperature=0.55
-        )
-        
-        raw_reply = response.choices[0].message.content.strip()
-        logger.info(f"Raw GPT response generated: {len(raw_reply)} chars")
-        
-        # (7) 格式化回覆
-        final_reply = format_response(raw_reply)
-        logger.info(f"Formatted response: {len(final_reply)} chars")
+def _run_pipeline(user_message, metadata):
+    """Multi-Agent 流程本體，將中間結果寫入 metadata"""
+    try:
+        reply, request, cacheable = _prepare(user_message, metadata)
+        if reply is not None:
+            return reply
         
-        return final_reply
+        # (5) 呼叫 OpenAI GPT-4o
+        response = openai.chat.completions.create(**request)
+        return _finish(user_message, response, metadata, cacheable)
         
     except Exception as e:
-        logger.error(f"Error generating response: {e}")
-        return "抱歉，我暫時無法處理您的請求。請稍後再試。"
+        logger.error("Error generating response: %s", e)
+        return ERROR_REPLY
+
+def _prepare(user_message, metadata):
+    """
+    呼叫 LLM 之前的步驟。可直接回覆（閒聊或快取命中）時回傳 (回覆, None, False)，
+    否則回傳 (None, 請求參數, 回覆是否可快取)。
+    """
+    # Step 1: 判斷是聊天還是專業問題
+    intent = recognize_intent(user_message)
+    metadata["intent"] = intent
+    logger.info("Recognized intent: %s", intent)
+    
+    # Step 2: 如果是普通聊天，簡單回覆
+    if intent == "chat":
+        return generate_casual_chat_response(user_message), None, False
+
+    # Step 3: 專業問題處理流程
+    # (1) 分類問題
+    category = classify_question(user_message)
+    metadata["category"] = category
+    logger.info("Question category: %s", category)
+    
+    # (2) 檢查是否需要特別引導（問題太模糊）
+    needs_followup = decide_need_followup(user_message)
+    metadata["needs_followup"] = needs_followup
+    
+    # (3) 獲取相關摘要（如有必要）
+    summary_context = fetch_recent_summaries_if_needed(user_message)
+    
+    # 不依賴摘要的問題，相同提問可直接重用先前的回覆（跨 worker 共用）
+    cacheable = not summary_context
+    if cacheable:
+        cached_reply = get_cache().get("responses", _response_key(user_message))
+        if cached_reply is not None:
+            logger.info("Response served from cache")
+            return cached_reply, None, False
+    
+    # (4) 建立最終 Prompt：分類固定的前綴在前，檢索條文與摘要在後
+    system_prompt = build_system_prompt(category, user_message, summary_context, needs_followup)
+    return None, build_chat_request(system_prompt, user_message), cacheable
+
+def _finish(user_message, response, metadata, cacheable):
+    """記錄 token 用量、格式化 LLM 回覆，並視情況寫入快取"""
+    if response.usage:
+        metadata["prompt_tokens"] = response.usage.prompt_tokens
+        metadata["completion_tokens"] = response.usage.completion_tokens
+        metadata["total_tokens"] = response.usage.total_tokens
+        metadata["cached_tokens"] = cached_prompt_tokens(response.usage)
+    
+    raw_reply = response.choices[0].message.content.strip()
+    logger.info("Raw GPT response generated: %d chars", len(raw_reply))
+    
+    # (6) 格式化回覆
+    final_reply = format_response(raw_reply)
+    logger.info("Formatted response: %d chars", len(final_reply))
+    
+    if cacheable:
+        get_cache().set("responses", _response_key(user_message), final_reply, ttl=RESPONSE_CACHE_TTL)
+    
+    return final_reply
+
+def _response_key(user_message):
+    return hashlib.sha256(user_message.encode("utf-8")).hexdigest()
 
 # 保留原有的圖像分析功能
 def analyze_image(base64_image):
@@ -463,5 +660,5 @@ def analyze_image(base64_image):
         )
         return response.choices[0].message.content.strip()
     except Exception as e:
-        logger.error(f"Error analyzing image: {e}")
+        logger.error("Error analyzing image: %s", e)
         return "抱歉，我無法分析這張圖片。"
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# 重播不會呼叫 OpenAI，但 openai_service 載入時需要 API key 才能建立 client
+os.environ.setdefault("OPENAI_API_KEY", "replay-stub")
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 5000
+FIELDS = ("intent", "category", "needs_followup")
+
+
+class _StubOpenAI:
+    """取代 OpenAI client，確保重播過程中不會有任何 API 呼叫"""
+
+    def __getattr__(self, name):
+        raise RuntimeError("OpenAI is stubbed out during replay")
+
+
+def _init_worker():
+    import openai_service
+    openai_service.openai = _StubOpenAI()
+    # 子行程只需要錯誤訊息
+    logging.getLogger().setLevel(logging.WARNING)
+
+def route_message(text):
+    """
+    執行呼叫 LLM 之前的路由流程，與 generate_response 相同：
+    閒聊訊息不分類，也不判斷是否需要引導。
+    """
+    from openai_service import recognize_intent, classify_question, decide_need_followup
+    intent = recognize_intent(text)
+    if intent == "chat":
+        return intent, None, False
+    return intent, classify_question(text), decide_need_followup(text)
+
+def _route_chunk(chunk):
+    return [(key, *route_message(text)) for key, text in chunk]
+
+
+def iter_corpus(path):
+    """
+    讀取 JSONL 語料，每行需有 text，可選 id 與標註欄位 intent / category / needs_followup。
+    回傳 (key, text, labels)。
+    """
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            labels = {field: item[field] for field in FIELDS if field in item}
+            yield str(item.get("id", line_no)), item["text"], labels
+
+def iter_conversations(start=None, end=None, limit=None, chunk_size=CHUNK_SIZE):
+    """以伺服器端游標讀取資料庫中的 user_message，回傳 (conversation id, text, {})"""
+    from sqlalchemy import select
+    from app import app, db
+    from models import Conversation
+
+    query = select(Conversation.id, Conversation.user_message).order_by(Conversation.id)
+    if start:
+        query = query.where(Conversation.timestamp >= datetime.datetime.combine(start, datetime.time.min))
+    if end:
+        query = query.where(Conversation.timestamp < datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time.min))
+    if limit:
+        query = query.limit(limit)
+
+    # app 與 models 在上方先載入，重播計時不會包含啟動時間
+    def rows():
+        with app.app_context():
+            result = db.session.execute(query.execution_options(stream_results=True, yield_per=chunk_size))
+            for conversation_id, text in result:
+                yield str(conversation_id), text, {}
+
+    return rows()
+
+def _collect(routed, results):
+    for key, intent, category, followup in routed:
+        results[key] = {"intent": intent, "category": category, "needs_followup": followup}
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def replay(messages, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    以行程池平行重播訊息。messages 為 (key, text, labels) 的可迭代物件。
+    回傳 (results, labels, elapsed)：results 為 {key: {intent, category, needs_followup}}。
+    """
+    labels = {}
+
+    def texts():
+        for key, text, item_labels in messages:
+            if item_labels:
+                labels[key] = item_labels
+            yield key, text
+
+    results = {}
+    started = time.perf_counter()
+    if workers == 1:
+        _init_worker()
+        for chunk in _chunks(texts(), chunk_size):
+            _collect(_route_chunk(chunk), results)
+    else:
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            # 同時送出的區塊數有上限，避免整份語料一次讀進記憶體
+            pending = deque()
+            for chunk in _chunks(texts(), chunk_size):
+                pending.append(executor.submit(_route_chunk, chunk))
+                if len(pending) >= workers * 2:
+                    _collect(pending.popleft().result(), results)
+            while pending:
+                _collect(pending.popleft().result(), results)
+    return results, labels, time.perf_counter() - started
+
+def build_report(results, labels, elapsed, baseline=None):
+    """彙整分布、與基準的路由差異、標註準確率與吞吐量"""
+    total = len(results)
+    report = {
+        "messages": total,
+        "elapsed_seconds": round(elapsed, 3),
+        "messages_per_second": round(total / elapsed) if elapsed else None,
+        "intent_distribution": dict(Counter(r["intent"] for r in results.values()).most_common()),
+        "category_distribution": dict(Counter(str(r["category"]) for r in results.values()).most_common()),
+        "followup_rate": round(sum(1 for r in results.values() if r["needs_followup"]) / total, 4) if total else 0,
+    }
+
+    if baseline is not None:
+        shifts = {}
+        for field in FIELDS:
+            moves = Counter()
+            for key, result in results.items():
+                before = baseline.get(key)
+                if before is not None and before.get(field) != result[field]:
+                    moves[f"{before.get(field)} -> {result[field]}"] += 1
+            shifts[field] = {"changed": sum(moves.values()), "moves": dict(moves.most_common(20))}
+        compared = sum(1 for key in results if key in baseline)
+        report["baseline"] = {"compared": compared, "shifts": shifts}
+
+    if labels:
+        accuracy = {}
+        for field in FIELDS:
+            pairs = [(item[field], results[key][field]) for key, item in labels.items()
+                     if field in item and key in results]
+            if not pairs:
+                continue
+            errors = Counter(f"{expected} -> {actual}" for expected, actual in pairs if expected != actual)
+            accuracy[field] = {
+                "labeled": len(pairs),
+                "accuracy": round(1 - sum(errors.values()) / len(pairs), 4),
+                "top_errors": dict(errors.most_common(10)),
+            }
+        report["accuracy"] = accuracy
+
+    return report
+
+def load_results(path):
+    with open(path, encoding="utf-8") as f:
+        return {item.pop("key"): item for item in map(json.loads, f)}
+
+def save_results(results, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for key, result in results.items():
+            f.write(json.dumps(dict(key=key, **result), ensure_ascii=False) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以歷史對話或標註語料重播意圖/分類/引導判斷（不呼叫 OpenAI）")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--corpus", help="JSONL 語料（text，可選 id、intent、category、needs_followup）")
+    source.add_argument("--from-db", action="store_true", help="重播資料庫中的 Conversation.user_message")
+    parser.add_argument("--start", type=lambda v: datetime.datetime.strptime(v, "%Y-%m-%d").date())
+    parser.add_argument("--end", type=lambda v: datetime.datetime.strptime(v, "%Y-%m-%d").date())
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="行程數，1 表示不使用行程池")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--save", help="將本次路由結果存成 JSONL，作為之後比較的基準")
+    parser.add_argument("--baseline", help="先前以 --save 存下的結果，用來計算路由變化")
+    args = parser.parse_args()
+
+    if args.corpus:
+        messages = iter_corpus(args.corpus)
+    else:
+        messages = iter_conversations(args.start, args.end, args.limit, args.chunk_size)
+
+    results, labels, elapsed = replay(messages, workers=args.workers, chunk_size=args.chunk_size)
+    baseline = load_results(args.baseline) if args.baseline else None
+    report = build_report(results, labels, elapsed, baseline)
+
+    if args.save:
+        save_results(results, args.save)
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import types
+import asyncio
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 使用暫存資料庫與日誌目錄，不影響正式資料；OpenAI 與 LINE 以固定延遲的替身取代，不會對外連線
+_workdir = tempfile.mkdtemp(prefix="serving-benchmark-")
+os.environ["APP_DATABASE_URL"] = "sqlite:///" + os.path.join(_workdir, "bench.db")
+os.environ["JOURNAL_DIR"] = os.path.join(_workdir, "journal")
+# 比較的是每則訊息各自呼叫 LLM 時的吞吐量，不合併訊息
+os.environ["DEBOUNCE_SECONDS"] = "0"
+for _name in ("OPENAI_API_KEY", "LINE_CHANNEL_ACCESS_TOKEN", "LINE_CHANNEL_SECRET"):
+    os.environ.setdefault(_name, "benchmark-stub")
+
+import logging
+import openai_service
+import async_app
+import app as sync_app
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+REPLY = "您好！以下是重點：\n✅ 先界定組織邊界與營運控制權。\n📌 依範疇一、二、三辨識排放源。\n請問貴公司屬於哪個產業？"
+
+
+def _completion():
+    usage = types.SimpleNamespace(prompt_tokens=600, completion_tokens=120, total_tokens=720,
+                                  prompt_tokens_details=types.SimpleNamespace(cached_tokens=0))
+    message = types.SimpleNamespace(content=REPLY)
+    return types.SimpleNamespace(usage=usage, choices=[types.SimpleNamespace(message=message)])
+
+
+class _SlowOpenAI:
+    """同步 client 替身：每次呼叫佔用執行緒 latency 秒"""
+
+    def __init__(self, latency):
+        self.chat = types.SimpleNamespace(completions=self)
+        self.latency = latency
+
+    def create(self, **kwargs):
+        time.sleep(self.latency)
+        return _completion()
+
+
+class _SlowAsyncOpenAI(_SlowOpenAI):
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        return _completion()
+
+
+class _LineApi:
+    def reply_message(self, reply_token, messages, **kwargs):
+        pass
+
+    def get_profile(self, user_id):
+        return types.SimpleNamespace(display_name=user_id)
+
+
+class _AsyncLineApi:
+    async def reply_message(self, reply_token, messages, **kwargs):
+        pass
+
+    async def get_profile(self, user_id):
+        return types.SimpleNamespace(display_name=user_id)
+
+
+def _events(count, users):
+    # 每則訊息內容不同，避免命中回覆快取
+    return [
+        types.SimpleNamespace(
+            message=types.SimpleNamespace(text=f"碳盤查範疇三怎麼計算？#{index}"),
+            source=types.SimpleNamespace(user_id=f"bench-user-{index % users}"),
+            reply_token=f"token-{index}",
+        )
+        for index in range(count)
+    ]
+
+def _peak_threads(stop, peak):
+    while not stop.is_set():
+        peak[0] = max(peak[0], threading.active_count())
+        time.sleep(0.01)
+
+def _measure(run, events):
+    stop, peak = threading.Event(), [threading.active_count()]
+    sampler = threading.Thread(target=_peak_threads, args=(stop, peak), daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    run(events)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    sampler.join()
+    return {
+        "messages": len(events),
+        "elapsed_seconds": round(elapsed, 3),
+        "messages_per_second": round(len(events) / elapsed, 1),
+        "peak_threads": peak[0],
+    }
+
+
+def bench_sync(events, concurrency):
+    """同步路徑：如同 gunicorn 以 concurrency 個執行緒處理請求"""
+    sync_app.line_bot_api = _LineApi()
+
+    def handle(event):
+        with sync_app.app.app_context():
+            sync_app.handle_text_message(event)
+
+    def run(events):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(handle, events))
+
+    return _measure(run, events)
+
+def bench_async(events, concurrency, executor_threads):
+    """非同步路徑：單一 event loop，同時處理最多 concurrency 則訊息"""
+    line_bot_api = _AsyncLineApi()
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(executor_threads))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def handle(event):
+            async with semaphore:
+                await async_app.handle_text_message(event, line_bot_api)
+
+        await asyncio.gather(*(handle(event) for event in events))
+
+    return _measure(lambda events: asyncio.run(main()), events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較同步與非同步處理路徑在 LLM 呼叫緩慢時的吞吐量")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="模擬的 OpenAI 回應時間（秒）")
+    parser.add_argument("--sync-threads", type=int, default=8, help="同步路徑的執行緒數（相當於 gunicorn worker 數）")
+    parser.add_argument("--concurrency", type=int, default=500, help="非同步路徑同時處理的訊息數")
+    parser.add_argument("--executor-threads", type=int, default=async_app.ASYNC_EXECUTOR_THREADS)
+    args = parser.parse_args()
+
+    openai_service.openai = _SlowOpenAI(args.llm_latency)
+    openai_service.async_openai = _SlowAsyncOpenAI(args.llm_latency)
+
+    report = {
+        "llm_latency_seconds": args.llm_latency,
+        "sync": dict(bench_sync(_events(args.messages, args.users), args.sync_threads),
+                     threads=args.sync_threads),
+        "async": dict(bench_async(_events(args.messages, args.users), args.concurrency, args.executor_threads),
+                      concurrency=args.concurrency, executor_threads=args.executor_threads),
+    }
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    main()